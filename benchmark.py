@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark and simulation harness for the ovpnmanager ranking pipeline.
+Runs vpn_server_rank() and vpn_server_random() offline against a synthetic server catalog
+served from a local HTTP server and a simulated network with per server latency, jitter and loss.
+Reports wall time, probes issued and selection regret against the true best server for each strategy.
+No root, ping or IPVanish access required.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import ovpnmanager
+
+COUNTRIES = {
+    "US": [("New-York", "nyc"), ("Los-Angeles", "lax"), ("Chicago", "chi"), ("Dallas", "dal")],
+    "GB": [("London", "lon"), ("Manchester", "man")],
+    "DE": [("Frankfurt", "fra"), ("Berlin", "ber")],
+    "AU": [("Sydney", "syd"), ("Melbourne", "mel")],
+    "JP": [("Tokyo", "tok")],
+}
+
+
+def get_arguments():
+    """
+    Get benchmark options
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the ovpnmanager ranking strategies offline")
+    parser.add_argument("--catalog-size", dest="catalog_size", type=int, default=300,
+                        help="Set number of servers in the synthetic catalog. Default is 300")
+    parser.add_argument("--strategies", dest="strategies", type=str, default="sample,tournament",
+                        help="Set comma separated ranking strategies to compare. Default is sample,tournament")
+    parser.add_argument("--runs", dest="runs", type=int, default=5,
+                        help="Set number of runs per strategy. Default is 5")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Set random seed of the simulated network and server selection. Default is 1")
+    parser.add_argument("--time-scale", dest="time_scale", type=float, default=0.1,
+                        help="Set how much of each simulated round trip time is slept. Default is 0.1")
+    parser.add_argument("--loss", dest="loss", type=float, default=0.05,
+                        help="Set the mean packet loss of the simulated servers. Default is 0.05")
+    parser.add_argument("--keep-history", dest="keep_history", action="store_true",
+                        help="Keep the probe history between runs of a strategy instead of starting fresh")
+    parser.add_argument("-s", "--servers", dest="servers", type=int, default=20,
+                        help="Set number of servers probed by the sample strategy. Default is 20")
+    parser.add_argument("-n", "--samples", dest="samples", type=int, default=3,
+                        help="Set number of samples per server. Default is 3")
+    parser.add_argument("--probe-budget", dest="probe_budget", type=int, default=300,
+                        help="Set tournament probe budget. Default is 300")
+    parser.add_argument("--probe-mode", dest="probe_mode", choices=["thread", "asyncio"], default="thread",
+                        help="Set probe mode. Default is thread")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", type=int, default=10,
+                        help="Set number of concurrent probes. Default is 10")
+    parser.add_argument("--deadline", dest="deadline", type=float, default=30,
+                        help="Set probe deadline in seconds. Default is 30")
+    return parser.parse_args()
+
+
+def build_network(catalog_size, mean_loss, rng):
+    """
+    Return a dict of server id to simulated network conditions and the synthetic catalog page.
+    Latency is set per city with a spread per server so nearby servers are similar.
+    """
+    cities = [(country, city, code) for country, country_cities in COUNTRIES.items()
+              for city, code in country_cities]
+    city_latency = {code: rng.uniform(10, 300) for country, city, code in cities}
+    network = {}
+    links = []
+    for number in range(catalog_size):
+        country, city, code = cities[number % len(cities)]
+        server_id = f"{code}-a{number // len(cities) + 1:02d}"
+        network[server_id] = {
+            "latency": city_latency[code] * rng.uniform(0.9, 1.6),
+            "jitter": rng.expovariate(1 / 8),
+            "loss": min(0.9, rng.expovariate(1 / mean_loss)) if mean_loss else 0,
+            "address": f"10.{number // 65536}.{number // 256 % 256}.{number % 256}",
+        }
+        links.append(f'<a href="ipvanish-{country}-{city}-{server_id}.ovpn">ipvanish-{country}-{city}-{server_id}.ovpn</a>')
+    page = "<html><body>\n" + "\n".join(links) + "\n</body></html>\n"
+    return network, page.encode()
+
+
+def true_score(conditions, score_weights=None):
+    """
+    Return the expected latency score of a server from its simulated conditions
+    """
+    weights = dict(ovpnmanager.DEFAULT_SCORE_WEIGHTS, **(score_weights or {}))
+    return (conditions["latency"] * (weights["median"] + weights["p90"]) + conditions["jitter"] * weights["jitter"]
+            + conditions["loss"] * weights["loss"])
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_catalog(page):
+    """
+    Serve the synthetic catalog page from a local HTTP server and return the server and its URL
+    """
+    class CatalogHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CatalogHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+class FakeNetwork:
+    """
+    Simulated network layer. Replaces DNS resolution and provides a probe backend that sleeps and
+    returns round trip times drawn from the per server latency, jitter and loss.
+    """
+
+    def __init__(self, network, time_scale, seed):
+        self.network = network
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.probes = 0
+        self.hosts = {}
+        for server_id, conditions in network.items():
+            self.hosts[conditions["address"]] = conditions
+            self.hosts[ovpnmanager.vpn_server_hostname(server_id)] = conditions
+
+    def resolve(self, host):
+        return [self.hosts[host]["address"]]
+
+    def sample(self, host):
+        conditions = self.hosts[host]
+        with self.lock:
+            self.probes += 1
+            lost = self.rng.random() < conditions["loss"]
+            rtt = max(0.1, self.rng.gauss(conditions["latency"], conditions["jitter"]))
+        if lost:
+            return None, ovpnmanager.PROBE_TIMEOUT
+        return rtt, rtt / 1000
+
+    def probe(self, host, interface=None):
+        rtt, wait = self.sample(host)
+        time.sleep(wait * self.time_scale)
+        return rtt
+
+    async def probe_async(self, host, interface=None):
+        rtt, wait = self.sample(host)
+        await asyncio.sleep(wait * self.time_scale)
+        return rtt
+
+
+def run_strategy(options, strategy, fake_network, run):
+    """
+    Rank and select a server with one strategy and return wall time, probes issued and the selected servers
+    """
+    random.seed(options.seed * 1000 + run)
+    fake_network.rng.seed(options.seed * 1000 + run)
+    fake_network.probes = 0
+    rank_settings = {
+        "probe_mode": options.probe_mode,
+        "concurrency": options.concurrency,
+        "deadline": options.deadline,
+        "probe_backend": "fake",
+        "samples": options.samples,
+        "strategy": strategy,
+        "probe_budget": options.probe_budget,
+    }
+    output = io.StringIO()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(output):
+        servers_ranked = ovpnmanager.vpn_server_rank(options.servers, None, **rank_settings)
+        selected = ovpnmanager.vpn_server_random()
+    wall_time = time.monotonic() - start
+    top_server = servers_ranked[0][1] if servers_ranked else None
+    return wall_time, fake_network.probes, top_server, selected.split(".")[0]
+
+
+def main():
+    """
+    Run the benchmark and show a summary table per strategy
+    """
+    options = get_arguments()
+    rng = random.Random(options.seed)
+    network, page = build_network(options.catalog_size, options.loss, rng)
+    scores = {server_id: true_score(conditions) for server_id, conditions in network.items()}
+    best_score = min(scores.values())
+    catalog_server, ovpnmanager.CATALOG_URL = serve_catalog(page)
+    fake_network = FakeNetwork(network, options.time_scale, options.seed)
+    ovpnmanager.PROBE_BACKENDS["fake"] = (fake_network.probe, fake_network.probe_async)
+    ovpnmanager.resolve_host = fake_network.resolve
+    print(f"Synthetic catalog of {len(network)} servers, true best server score {best_score:.0f}")
+    column_widths = [12, 10, 8, 12, 12]
+    ovpnmanager.table_decorator(column_widths, "+", "-")
+    ovpnmanager.table_row_data(column_widths, ["STRATEGY", "WALL TIME", "PROBES", "TOP REGRET", "PICK REGRET"])
+    ovpnmanager.table_decorator(column_widths, "+", "=")
+    try:
+        for strategy in options.strategies.split(","):
+            run_dir = None
+            results = []
+            for run in range(options.runs):
+                if not options.keep_history or run_dir is None:
+                    if run_dir:
+                        shutil.rmtree(run_dir)
+                    # Each run gets its own catalog cache, probe history and ranked list
+                    run_dir = tempfile.mkdtemp(prefix="ovpnmanager-benchmark-")
+                    ovpnmanager.STATE_DIR = run_dir
+                results.append(run_strategy(options, strategy, fake_network, run))
+            shutil.rmtree(run_dir)
+            wall_time = statistics.mean(result[0] for result in results)
+            probes = statistics.mean(result[1] for result in results)
+            top_regret = statistics.mean(scores[result[2]] - best_score for result in results if result[2])
+            pick_regret = statistics.mean(scores[result[3]] - best_score for result in results)
+            ovpnmanager.table_row_data(column_widths, [strategy, f"{wall_time:.2f}s", f"{probes:.0f}",
+                                                       f"{top_regret:.1f}", f"{pick_regret:.1f}"])
+    finally:
+        catalog_server.shutdown()
+    ovpnmanager.table_decorator(column_widths, "+", "-")
+    print(f"Mean of {options.runs} runs. Regret is the true score above the best server in the catalog.")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,8 +19,26 @@ import time
 import argparse
 import json
 import os
-from operator import itemgetter
-from urllib.request import urlopen
+import math
+import statistics
+import sqlite3
+import asyncio
+import concurrent.futures
+import functools
+import sched
+import tempfile
+import threading
+import fcntl
+import ssl
+import struct
+import codecs
+import contextlib
+import xml.etree.ElementTree as ElementTree
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlparse, parse_qs
 
 
 class TermShow:
@@ -157,31 +175,274 @@ def task_pass():
         f'\r[{TermShow.BRGREEN}{TermShow.BOLD}{TermShow.TICK}{TermShow.RESET}]', end="\n", flush=True)
 
 
-def get_arguments():
+COMMANDS = ("rotate", "rank", "status", "probe", "catalog", "share")
+
+
+def get_arguments(argv=None):
+    """
+    Get the subcommand and command line arguments for use in program functions.
+    Without a subcommand rotate is used so existing cron jobs keep working.
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        argv.insert(0, "rotate")
+    parser = argparse.ArgumentParser(description="Rank IPVanish servers and rotate the OpenVPN server")
+    commands = parser.add_subparsers(dest="command", metavar="{" + ",".join(COMMANDS) + "}")
+    options_parser = argparse.ArgumentParser(add_help=False)
+    options_parser.add_argument("--servers", "-s", dest="servers", type=int, default=30,
+                                help="Set number of servers to test for ping latency response. Default is 30")
+    options_parser.add_argument("--filter", "-f", dest="filter", type=str, default=None,
+                                help="Set server country code for VPN server location such as US. Several countries \
+and cities can be given such as us,gb or us:nyc,us:chicago. Default is None")
+    options_parser.add_argument("--probe-mode", dest="probe_mode", type=str, default="thread",
+                                choices=["thread", "asyncio"],
+                                help="Run latency probes from a thread pool or an asyncio event loop. Default is \
+thread")
+    options_parser.add_argument("--concurrency", "-c", dest="concurrency", type=int, default=10,
+                                help="Set maximum number of servers probed at the same time. Default is 10")
+    options_parser.add_argument("--deadline", dest="deadline", type=float, default=10,
+                                help="Set overall time limit in seconds for probing all servers. Default is 10")
+    options_parser.add_argument("--catalog-ttl", dest="catalog_ttl", type=float, default=24,
+                                help="Set number of hours the cached server catalog is used before it is refreshed. \
+Default is 24")
+    options_parser.add_argument("--samples", "-n", dest="samples", type=int, default=3,
+                                help="Set number of latency samples taken from each server. Default is 3")
+    options_parser.add_argument("--score-weights", dest="score_weights", type=str, default=None,
+                                help="Set ranking score weights for median, p90, jitter and loss such as \
+median=1,jitter=2,loss=500. Default is median=1,p90=0,jitter=1,loss=500")
+    options_parser.add_argument("--probe-backend", "-b", dest="probe_backend", type=str, default="auto",
+                                choices=["auto", "icmp", "raw", "tcp", "ping"],
+                                help="Set latency probe backend. icmp uses unprivileged ICMP sockets, raw uses \
+raw ICMP sockets, tcp measures connect time on port 443 and ping runs the system ping command. Default is auto")
+    options_parser.add_argument("--strategy", dest="strategy", type=str, default="sample",
+                                choices=["sample", "tournament"],
+                                help="Set server selection strategy. sample probes --servers servers --samples times, \
+tournament probes a wide set of servers once and re-probes only the best within --probe-budget. Default is sample")
+    options_parser.add_argument("--probe-budget", dest="probe_budget", type=int, default=300,
+                                help="Set total number of probes for the tournament strategy. Default is 300")
+    options_parser.add_argument("--finalists", dest="finalists", type=int, default=0,
+                                help="Set number of top latency servers re-ranked on port 443 connect time, TLS \
+handshake time and throughput, at least twice the number of top servers. Default is 0 (disabled)")
+    options_parser.add_argument("--finalist-time", dest="finalist_time", type=float, default=5,
+                                help="Set maximum seconds for the finalist stage. Default is 5")
+    options_parser.add_argument("--bandwidth-path", dest="bandwidth_path", type=str, default="/",
+                                help="Set HTTPS path downloaded from finalists to measure throughput. Default is /")
+    options_parser.add_argument("--geo", dest="geo", action="store_true",
+                                help="Probe the servers nearest to our location first instead of a random selection")
+    options_parser.add_argument("--geo-lookups", dest="geo_lookups", type=int, default=20,
+                                help="Set maximum number of server cities looked up on ipinfo.io per run for --geo. \
+Coordinates are cached. Default is 20")
+    options_parser.add_argument("--location", dest="location", type=str, default=None,
+                                help="Set our location as latitude,longitude for --geo instead of looking it up \
+on ipinfo.io")
+    options_parser.add_argument("--pin-ip", dest="pin_ip", action="store_true",
+                                help="Write the resolved server address on the OpenVPN remote line so OpenVPN does not \
+resolve the hostname at start")
+    options_parser.add_argument("--state-dir", dest="state_dir", type=str, default=STATE_DIR,
+                                help="Set directory of the ranked server list, caches, probe history and run \
+record. Default is the directory of this script")
+    options_parser.add_argument("--run-record", dest="run_record", type=str, default=RUN_RECORD_FILE,
+                                help=f"Set file the JSON record of phase timings, probes, downtime and chosen \
+server is written to after each run, relative to --state-dir. Default is {RUN_RECORD_FILE}")
+    options_parser.add_argument("--prometheus-file", dest="prometheus_file", type=str, default=None,
+                                help="Also write the run metrics to a Prometheus node exporter textfile collector file \
+such as /var/lib/node_exporter/textfile_collector/ovpnmanager.prom")
+    options_parser.add_argument("--clients", dest="clients", type=str, default=None,
+                                help="Rotate several OpenVPN clients from one ranking, each on a different \
+server. A comma separated list of config files or names in /etc/openvpn (Debian) or client ids (pfSense) \
+such as client1,client2 or 1,2")
+    options_parser.add_argument("--uplinks", dest="uplinks", type=str, default=None,
+                                help="Probe every server over each of several WAN interfaces such as igb0,igb1 and \
+bind the OpenVPN client to the uplink of the chosen server. Default is None")
+    options_parser.add_argument("--transports", dest="transports", type=str, default=None,
+                                help="Measure OpenVPN handshake time of each transport and port such as \
+udp:443,udp:1194,tcp:443 on the top servers and use the fastest. Default is None (proto and port unchanged)")
+    options_parser.add_argument("--shared-results", dest="shared_results", type=str, default=None,
+                                help="Share probe results with other gateways on the same site through a file on a \
+shared mount or the URL of an ovpnmanager share endpoint such as http://10.0.0.2:8765. Default is None")
+    options_parser.add_argument("--shared-ttl", dest="shared_ttl", type=float, default=15,
+                                help="Set minutes shared probe results are used before they are probed again. \
+Default is 15")
+    options_parser.add_argument("--rotation", dest="rotation", type=str, default="stop", choices=["stop", "live"],
+                                help="Set rotation mode. stop stops OpenVPN before ranking, live ranks while \
+the tunnel is up with probes bound to the physical interface then restarts OpenVPN once. Default is stop")
+    options_parser.add_argument("--interface", "-i", dest="interface", type=str, default=None,
+                                help="Set network interface probes are sent from. Default is the default route \
+interface in live rotation mode, otherwise None")
+    options_parser.add_argument("--tun-interface", dest="tun_interface", type=str, default=None,
+                                help="Set OpenVPN tunnel interface watched for readiness. Default is tun0 or \
+ovpnc2 on pfSense")
+    options_parser.add_argument("--management", "-m", dest="management", type=str, default=None,
+                                help="Set OpenVPN management interface as host:port or unix socket path used to detect \
+when the tunnel is connected. Default is None")
+    options_parser.add_argument("--ready-timeout", dest="ready_timeout", type=float, default=30,
+                                help="Set maximum seconds to wait for OpenVPN to stop or connect. Default is 30")
+    options_parser.add_argument("--daemon", "-d", dest="daemon", action="store_true",
+                                help="Keep running, re-rank servers on a schedule with the tunnel up and rotate \
+only when the current server score is above --rotate-score or it is older than --max-age")
+    options_parser.add_argument("--probe-interval", dest="probe_interval", type=float, default=30,
+                                help="Set minutes between probe cycles in daemon mode. Default is 30")
+    options_parser.add_argument("--rotate-score", dest="rotate_score", type=float, default=250,
+                                help="Set latency score above which the current server is replaced in daemon mode. \
+Default is 250")
+    options_parser.add_argument("--max-age", dest="max_age", type=float, default=4,
+                                help="Set hours after which the current server is replaced in daemon mode. \
+Default is 4")
+    options_parser.add_argument("--monitor", dest="monitor", action="store_true",
+                                help="Only monitor the active tunnel and fail over to the next ranked server \
+when it degrades")
+    options_parser.add_argument("--monitor-interval", dest="monitor_interval", type=float, default=60,
+                                help="Set seconds between tunnel health checks in monitor and daemon mode, 0 disables \
+health checks in daemon mode. Default is 60")
+    options_parser.add_argument("--monitor-target", dest="monitor_target", type=str, default="1.1.1.1",
+                                help="Set host probed through the tunnel by health checks. Default is 1.1.1.1")
+    options_parser.add_argument("--monitor-score", dest="monitor_score", type=float, default=300,
+                                help="Set tunnel latency score above which a health check counts as degraded. \
+Default is 300")
+    options_parser.add_argument("--monitor-failures", dest="monitor_failures", type=int, default=3,
+                                help="Set number of degraded health checks in a row before failing over. Default is 3")
+    options_parser.add_argument("--history-half-life", dest="history_half_life", type=float, default=24,
+                                help="Set hours after which a previous probe result counts half in ranking. \
+Default is 24")
+    options_parser.add_argument("--history-weight", dest="history_weight", type=float, default=0.3,
+                                help="Set weight of probe history in the ranking score from 0 to 1. Default is 0.3")
+    options_parser.add_argument("--explore", dest="explore", type=float, default=0.3,
+                                help="Set fraction of servers picked at random instead of from probe history. \
+Default is 0.3")
+    commands.add_parser("rotate", parents=[options_parser],
+                        help="Rank servers and rotate the OpenVPN client to a new server (default)")
+    commands.add_parser("rank", parents=[options_parser],
+                        help="Rank servers and write the ranked server list without changing OpenVPN")
+    probe_parser = commands.add_parser("probe", parents=[options_parser], help="Probe a single server")
+    probe_parser.add_argument("server", help="Server id or hostname such as nyc-a01")
+    commands.add_parser("catalog", parents=[options_parser],
+                        help="Show the countries, cities and number of servers in the server catalog")
+    share_parser = commands.add_parser("share", help="Serve shared probe results to other gateways over HTTP")
+    share_parser.add_argument("--listen", dest="listen", type=str, default="127.0.0.1:8765",
+                              help="Set address and port to listen on. The endpoint has no authentication, \
+only listen on a trusted network. Default is 127.0.0.1:8765")
+    status_parser = commands.add_parser("status", help="Show the current server, last ranking and last probe stats \
+from saved state without any network or service access")
+    status_parser.add_argument("--config", dest="config", type=str, default=None,
+                               help="Set OpenVPN config file or pfSense config.xml. Default is detected from the OS")
+    status_parser.add_argument("--state-dir", dest="state_dir", type=str, default=STATE_DIR,
+                               help="Set directory of the ranked server list, caches, probe history and run \
+record. Default is the directory of this script")
+    status_parser.add_argument("--run-record", dest="run_record", type=str, default=RUN_RECORD_FILE,
+                               help=f"Set JSON run record file to read, relative to --state-dir. \
+Default is {RUN_RECORD_FILE}")
+    status_parser.add_argument("--json", dest="json", action="store_true", help="Show status as JSON")
+    return parser.parse_args(argv)
+
+
+def check_arguments(args):
     """
-    Get command line arguments for use in program functions.
+    Validate command line arguments, invalid values are reset to their defaults
     """
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--servers", "-s", dest="servers", type=int, default=30,
-                        help="Set number of servers to test for ping latency response. Default is 30")
-    parser.add_argument("--filter", "-f", dest="filter", type=str, default=None,
-                        help="Set server country code for VPN server location such as US. Default is None")
-    args = parser.parse_args()
     if args:
         if args.servers:
             task_info(f"Server list count set to {args.servers}")
         if args.filter:
-            if len(args.filter) > 2:
+            try:
+                parse_server_filter(args.filter)
+                filter_valid = True
+            except ValueError:
+                filter_valid = False
+            if not filter_valid:
                 task_error(
-                    f"The specified -f filter country code {args.filter} is invalid.")
+                    f"The specified -f filter {args.filter} is invalid.")
                 task_info("Resetting country filter to None")
                 args.filter = None
             else:
                 task_info(f"Server country filter set to {args.filter}")
+        if args.concurrency < 1:
+            task_error(f"The specified -c concurrency {args.concurrency} is invalid.")
+            task_info("Resetting concurrency to 1")
+            args.concurrency = 1
+        if args.samples < 1:
+            task_error(f"The specified -n samples {args.samples} is invalid.")
+            task_info("Resetting samples to 1")
+            args.samples = 1
+        if args.strategy == "tournament":
+            if args.probe_budget < 1:
+                task_error(f"The specified --probe-budget {args.probe_budget} is invalid.")
+                task_info("Resetting --probe-budget to 300")
+                args.probe_budget = 300
+            task_info(f"Tournament strategy set with a budget of {args.probe_budget} probes")
+        if args.score_weights:
+            try:
+                args.score_weights = parse_score_weights(args.score_weights)
+                task_info(f"Ranking score weights set to {args.score_weights}")
+            except ValueError as e:
+                task_error(f"The specified score weights {args.score_weights} are invalid. {e}")
+                task_info("Resetting score weights to default")
+                args.score_weights = None
+        for name in ("history_weight", "explore"):
+            if not 0 <= getattr(args, name) <= 1:
+                task_error(f"The specified --{name.replace('_', '-')} {getattr(args, name)} is invalid.")
+                task_info(f"Resetting --{name.replace('_', '-')} to 0.3")
+                setattr(args, name, 0.3)
+        if args.monitor and args.monitor_interval <= 0:
+            task_error(f"The specified --monitor-interval {args.monitor_interval} is invalid.")
+            task_info("Resetting --monitor-interval to 60")
+            args.monitor_interval = 60
+        args.clients = [client.strip() for client in (args.clients or "").split(",") if client.strip()]
+        args.uplinks = [uplink.strip() for uplink in (args.uplinks or "").split(",") if uplink.strip()] or None
+        if args.transports:
+            try:
+                args.transports = parse_transports(args.transports)
+            except ValueError as e:
+                task_error(f"The specified --transports {args.transports} are invalid. {e}")
+                task_info("Resetting --transports to None")
+                args.transports = None
+        if args.location:
+            try:
+                parse_location(args.location)
+            except ValueError:
+                task_error(f"The specified --location {args.location} is invalid.")
+                task_info("Resetting --location to None")
+                args.location = None
+        if args.history_half_life <= 0:
+            task_error(f"The specified --history-half-life {args.history_half_life} is invalid.")
+            task_info("Resetting --history-half-life to 24")
+            args.history_half_life = 24
+        task_info(f"Probing up to {args.concurrency} servers at once using {args.probe_mode} mode")
         print()
     return args
 
 
+def get_rank_settings(options):
+    """
+    Return the ranking related command line options as keyword arguments for vpn_server_rank()
+    """
+    return {
+        "probe_mode": options.probe_mode,
+        "concurrency": options.concurrency,
+        "deadline": options.deadline,
+        "probe_backend": options.probe_backend,
+        "samples": options.samples,
+        "score_weights": options.score_weights,
+        "catalog_ttl": options.catalog_ttl,
+        "history_half_life": options.history_half_life,
+        "history_weight": options.history_weight,
+        "explore": options.explore,
+        "strategy": options.strategy,
+        "probe_budget": options.probe_budget,
+        "interface": options.interface,
+        "finalists": options.finalists,
+        "finalist_time": options.finalist_time,
+        "bandwidth_path": options.bandwidth_path,
+        "top_servers": max(5, len(options.clients)),
+        "shared_results": options.shared_results,
+        "transports": options.transports,
+        "shared_ttl": options.shared_ttl,
+        "uplinks": options.uplinks,
+        "geo": options.geo,
+        "geo_lookups": options.geo_lookups,
+        "location": options.location,
+    }
+
+
 def run_command_shell(cmd):
     """
     Run an OS based command and return the output.
@@ -239,48 +500,240 @@ def table_row_data(column_widths, row_data, color=""):
                     f" {seperator} {color}{data: <{width}}{TermShow.RESET} {seperator}", end="\n", flush=True)
 
 
-def fetch_server_configs(server_filter):
+# State files are kept in one directory so cron runs and status find them from any working directory
+STATE_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_URL = "https://www.ipvanish.com/software/configs/"
+CATALOG_CACHE_FILE = "vpn_server_catalog.json"
+CATALOG_VERSION = 2
+RANKED_SERVER_FILE = "ranked_vpn_server_list.txt"
+RANKED_DETAILS_FILE = "ranked_vpn_server_details.json"
+# Server ids look like nyc-a01
+SERVER_ID_PATTERN = re.compile(r'[A-Za-z0-9]+-[A-Za-z0-9]+')
+# Config file names look like ipvanish-US-New-York-nyc-a01.ovpn with an optional -tcp or -udp suffix
+SERVER_CONFIG_PATTERN = re.compile(
+    r'ipvanish-(?P<country>[A-Za-z]{2})-(?P<city>[\w\.-]+?)-(?P<server_id>' + SERVER_ID_PATTERN.pattern + r')'
+    r'(?:-(?P<protocol>tcp|udp))?\.ovpn')
+# Longest config file name expected, used to keep the end of each chunk for a match split across chunks
+SERVER_CONFIG_MAX_LENGTH = 200
+
+
+def state_path(filename):
+    """
+    Return the path of a state file in STATE_DIR, absolute paths are returned unchanged
+    """
+    return os.path.join(STATE_DIR, filename)
+
+
+def parse_server_configs(chunks):
+    """
+    Incrementally parse server config file names from chunks of the configs page and yield one
+    record per unique server with country, city, city code, server id and protocol.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    seen = set()
+    buffer = ""
+    chunks = iter(chunks)
+    finished = False
+    while not finished:
+        chunk = next(chunks, None)
+        finished = chunk is None
+        buffer += decoder.decode(chunk or b'', final=finished)
+        # A match ending near the end of the buffer may continue in the next chunk
+        safe_end = len(buffer) if finished else max(0, len(buffer) - SERVER_CONFIG_MAX_LENGTH)
+        keep_from = safe_end
+        for match in SERVER_CONFIG_PATTERN.finditer(buffer):
+            if match.end() > safe_end:
+                keep_from = min(keep_from, match.start())
+                break
+            server_id = match.group("server_id").lower()
+            if server_id in seen:
+                continue
+            seen.add(server_id)
+            yield {
+                "country": match.group("country").upper(),
+                "city": match.group("city"),
+                "city_code": server_id.split("-")[0],
+                "server_id": server_id,
+                "protocol": (match.group("protocol") or "udp").lower(),
+            }
+        buffer = buffer[keep_from:]
+
+
+def read_chunks(response, chunk_size=65536):
+    """
+    Yield chunks of an HTTP response until it is exhausted
+    """
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def build_catalog_index(servers):
+    """
+    Build an index of lower case country code to city code to a list of server ids
+    """
+    index = {}
+    for server_id, record in servers.items():
+        cities = index.setdefault(record["country"].lower(), {})
+        cities.setdefault(record["city_code"], []).append(server_id)
+    return index
+
+
+def load_catalog_cache():
+    """
+    Load the cached server catalog or return None if there is no usable cache
+    """
+    try:
+        with open(state_path(CATALOG_CACHE_FILE)) as cache_file:
+            catalog = json.load(cache_file)
+        if catalog.get("version") == CATALOG_VERSION and catalog.get("servers"):
+            return catalog
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def save_json_file(filename, data):
+    """
+    Write data to a JSON file. A temporary file is renamed over the file so a failed
+    write never leaves a partial file behind.
+    """
+    try:
+        write_file_atomic(filename, json.dumps(data))
+    except OSError as e:
+        task_error(f"Unable to write {filename}. {e}")
+
+
+def save_catalog_cache(catalog):
     """
-    Fetch IPVanish server config file and extract server names
+    Write the server catalog cache
     """
-    config_url = "https://www.ipvanish.com/software/configs/"
+    save_json_file(state_path(CATALOG_CACHE_FILE), catalog)
+
+
+def fetch_catalog(catalog_ttl=24):
+    """
+    Return the IPVanish server catalog with server records by server id and the country and city index.
+    The cached catalog is used while it is younger than catalog_ttl hours, then refreshed with a
+    conditional GET. If the refresh fails the stale cache is used.
+    """
+    catalog = load_catalog_cache()
+    if catalog:
+        age = time.time() - catalog.get("fetched", 0)
+        if age < catalog_ttl * 3600:
+            task_info(f"Using cached server catalog ({len(catalog['servers'])} servers, "
+                      f"{age / 3600:.1f} hours old)")
+            return catalog
     task_start(f"Fetching IPVanish server locations")
+    headers = {}
+    if catalog and catalog.get("etag"):
+        headers["If-None-Match"] = catalog["etag"]
+    if catalog and catalog.get("last_modified"):
+        headers["If-Modified-Since"] = catalog["last_modified"]
     try:
-        response = urlopen(config_url)
-        url_data = response.read()
-        url_text = url_data.decode('utf-8')
+        response = urlopen(Request(CATALOG_URL, headers=headers), timeout=15)
+        servers = {record["server_id"]: record for record in parse_server_configs(read_chunks(response))}
+        if not servers:
+            raise ValueError("No servers found in server configs page.")
+        catalog = {
+            "version": CATALOG_VERSION,
+            "fetched": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "servers": servers,
+            "index": build_catalog_index(servers),
+        }
         task_pass()
+    except HTTPError as e:
+        if e.code != 304 or not catalog:
+            return fetch_catalog_failed(catalog, e)
+        task_pass()
+        task_info("Server catalog has not changed since last fetch")
+        catalog["fetched"] = time.time()
     except Exception as e:
-        task_fail()
-        task_error(e)
+        return fetch_catalog_failed(catalog, e)
+    save_catalog_cache(catalog)
+    return catalog
+
+
+def fetch_catalog_failed(catalog, error):
+    """
+    Fall back to a stale catalog cache when the server configs page can not be fetched.
+    Called by fetch_catalog()
+    """
+    task_fail()
+    task_error(error)
+    if not catalog:
         task_error("Failed to fetch server configs.")
         sys.exit(1)
+    task_info(f"Using stale server catalog cache from {time.ctime(catalog.get('fetched', 0))}")
+    return catalog
+
+
+def parse_server_filter(server_filter):
+    """
+    Split a server filter into (country, city) terms. Terms are separated by commas and are a
+    country code (us), a country code and city code or city name (us:nyc, us:new-york) or a city code (nyc).
+    """
+    terms = []
+    for term in server_filter.lower().split(","):
+        term = term.strip()
+        if re.fullmatch(r'[a-z]{2}', term):
+            terms.append((term, None))
+        elif re.fullmatch(r'[a-z]{2}:[\w\.-]+', term):
+            terms.append(tuple(term.split(":", 1)))
+        elif re.fullmatch(r'[a-z]{3}', term):
+            terms.append((None, term))
+        else:
+            raise ValueError(f"Invalid filter term {term}")
+    return terms
+
+
+def filter_catalog(catalog, server_filter):
+    """
+    Return the server ids of the catalog matching a server filter using the country and city index
+    """
+    index = catalog["index"]
+    if not server_filter:
+        return list(catalog["servers"])
+    server_ids = []
+    for country, city in parse_server_filter(server_filter):
+        countries = [country] if country else list(index)
+        for country_code in countries:
+            cities = index.get(country_code, {})
+            if not city:
+                for city_servers in cities.values():
+                    server_ids += city_servers
+            elif city in cities:
+                server_ids += cities[city]
+            else:
+                # Match a city name such as new-york
+                for city_servers in cities.values():
+                    if catalog["servers"][city_servers[0]]["city"].lower() == city:
+                        server_ids += city_servers
+    return list(dict.fromkeys(server_ids))
+
+
+def fetch_server_configs(server_filter, catalog_ttl=24):
+    """
+    Fetch IPVanish server catalog and return (location, server id) of the servers matching the filter
+    """
+    catalog = fetch_catalog(catalog_ttl)
 
     if server_filter:
         task_info(f"Filtering server list for {server_filter} based servers")
     try:
-        extracted_servers = []
-        # currently filtering only US servers remove US for all
-        if server_filter:
-            extracted_servers = re.findall(
-                r'ipvanish-{0}[\w\.-]+.ovpn'.format(server_filter), url_text, re.IGNORECASE)
-        else:
-            extracted_servers = re.findall(r'ipvanish-[\w\.-]+.ovpn', url_text)
-        unique_servers = list(dict.fromkeys(extracted_servers))
-        if not unique_servers:
-            task_error(
-                "No servers found. An invalid country filter may have been applied.")
-            sys.exit(1)
-        vpn_server_list = []
-        for server in unique_servers:
-            server_full = server[12:][:-5]
-            server_location = server_full[:-8]
-            server_id = server_full[-7:]
-            vpn_server_list.append((server_location, server_id))
-        return vpn_server_list
-    except Exception as e:
-        task_fail()
+        server_ids = filter_catalog(catalog, server_filter)
+    except ValueError as e:
         task_error(e)
+        server_ids = []
+    if not server_ids:
+        task_error(
+            "No servers found. An invalid country filter may have been applied.")
+        sys.exit(1)
+    return [(catalog["servers"][server_id]["city"], server_id) for server_id in server_ids]
 
 
 def check_os():
@@ -301,316 +754,3013 @@ def check_os():
         task_error("No compatible OS found")
 
 
-def vpn_server_ping(server_count, server_filter):
+PROBE_TIMEOUT = 1
+INTERFACE_ADDRESSES = {}
+TCP_PROBE_PORT = 443
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def vpn_server_hostname(server_id):
     """
-    Ping IPVanish servers and rate based on ping latency
-    Called by vpn_server_rank()
+    Return the full hostname for an IPVanish server id such as nyc-a01
     """
-    print()
-    vpn_server_list = []
-    vpn_server_list = fetch_server_configs(server_filter)
-    number_of_servers = server_count
-    task_info(f"Total servers found: {len(vpn_server_list)}")
-    random_server_list = random.sample(vpn_server_list, number_of_servers)
-    print(f"\nRandom {number_of_servers} VPN server ping response times...")
-    column_widths = [4, 14, 8, 6, 10]
-    column_labels = ["No.", "LOCATION", "SERVER", "PING", "RATING"]
-    table_decorator(column_widths, "+", "-")
-    table_row_data(column_widths, column_labels)
-    table_decorator(column_widths, "+", "=")
-    vpn_server_results = []
-    count = 1
-    for vpn_server in random_server_list:
-        server_location = vpn_server[0]
-        server_id = vpn_server[1]
-        cmd = str("ping -c 1 -q -s 16 -W 1 " + server_id +
-                  ".ipvanish.com 2> /dev/null | awk -F'/' '/avg/{print $5}'")
-        try:
-            ping_result = run_command_shell(cmd)
-            if ping_result:
-                ping_result = int(float(ping_result))
-            if not ping_result:
-                ping_rating = "NO RESPONSE"
-                # Add 999 if no response to prevent problems with sort.
-                ping_result = 999
-            elif ping_result <= 150:
-                ping_rating = 'EXCELLENT'
-                result_color = TermShow.BRGREEN
-            elif 151 <= ping_result <= 200:
-                ping_rating = 'GOOD'
-                result_color = TermShow.GREEN
-            elif 201 <= ping_result <= 250:
-                ping_rating = 'AVERAGE'
-                result_color = TermShow.YELLOW
-            elif ping_result >= 251:
-                ping_rating = 'POOR'
-                result_color = TermShow.BRRED
-            result_data = [str(count), str(server_location).upper(), server_id, str(ping_result) + "ms", ping_rating]
-            table_row_data(column_widths, result_data, result_color)
-            vpn_server_results.append(
-                (server_location, server_id, ping_result, ping_rating))
-            count += 1
-        except Exception as e:
-            task_error(e)
-    table_decorator(column_widths, "+", "-")
-    print()
-    return vpn_server_results
+    return server_id + ".ipvanish.com"
+
 
+DNS_CACHE_FILE = "vpn_server_dns.json"
+DNS_CACHE_TTL_MINUTES = 60
 
-def vpn_server_rank(server_count, server_filter):
+
+def resolve_host(host):
     """
-    Sort IPVanish service list based on latency and narrow down list to top 5 and write to file
-    Calls vpn_server_ping()
+    Return the IPv4 and IPv6 addresses of a host, IPv4 addresses first
     """
-    vpn_server_results = []
-    vpn_server_results = vpn_server_ping(server_count, server_filter)
-    top_server_count = 5
-    print(f"Top {top_server_count} rated servers based on latency")
-    # This sorts list by latency time
-    servers_ranked = sorted(vpn_server_results, key=itemgetter(2))
-    # Write top 10 vpn servers to txt file and display
-    vpn_server_file = open('ranked_vpn_server_list.txt', 'w')
-    count = 1
-    column_widths = [4, 14, 8, 6, 10]
-    column_labels = ["RANK", "LOCATION", "SERVER", "PING", "RATING"]
-    table_decorator(column_widths, "+", "-")
-    table_row_data(column_widths, column_labels)
-    table_decorator(column_widths, "+", "=")
-    for server in servers_ranked[:top_server_count]:
-        server_location = server[0]
-        server_id = server[1]
-        server_ping = server[2]
-        server_rating = server[3]
-        result_data = [str(count), str(server_location).upper(), server_id, str(server_ping) + "ms", server_rating]
-        table_row_data(column_widths, result_data)
-        full_server_name = server[1] + ".ipvanish.com"
-        vpn_server_file.write(full_server_name + "\n")
-        count += 1
-    table_decorator(column_widths, "+", "-")
-    vpn_server_file.close()
-    print()
+    addresses = []
+    for family, _, _, _, sockaddr in socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return sorted(addresses, key=lambda address: ":" in address)
 
 
-def vpn_server_random():
+def load_dns_cache():
     """
-    Read top 5 server list file and select random server called by update_openvpn_config()
+    Load the cached server addresses
     """
-    vpn_server_file = open('ranked_vpn_server_list.txt', 'r')
-    ranked_vpn_server_list = vpn_server_file.read().splitlines()
-    vpn_server_file.close()
-    random_vpn_server = random.choice(ranked_vpn_server_list)
-    task_info(f"Random new server: {random_vpn_server}")
-    return random_vpn_server
+    try:
+        with open(state_path(DNS_CACHE_FILE)) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
 
 
-def update_openvpn_config(filename, new_server):
+def resolve_servers(servers, concurrency=10, deadline=10):
     """
-    Update the specified openvpn configuration file with new server information.
+    Resolve server hostnames concurrently and return a dict of server id to address.
+    Answers are cached on disk for DNS_CACHE_TTL_MINUTES (getaddrinfo does not return the record TTL).
+    A stale cached answer is still used when a lookup fails.
     """
-    server_find = "ipvanish.com"
-    with open(filename) as config_file:
-        config_data = config_file.read()
-        try:
-            old_server = re.findall(
-                r'[\w\.-]+{0}'.format(server_find), config_data)[0]
-            task_info(f'Found old server: {old_server}')
-            task_start(f'Updating new server in config file: {filename}')
-            if old_server and old_server != new_server:
-                new_config_data = config_data.replace(old_server, new_server)
-                with open(filename, "w") as new_config_file:
-                    new_config_file.write(new_config_data)
-                    task_pass()
-            elif old_server == new_server:
-                task_pass()
-                task_info(
-                    f'The new server is the same as the old server. No changes required.')
-        except Exception as e:
-            task_fail()
-            task_error(f'No match for text "*{server_find}" in {filename}')
-            task_error(e)
-    config_file.close()
+    dns_cache = load_dns_cache()
+    now = time.time()
+    expired = [server for server in servers
+               if now - dns_cache.get(vpn_server_hostname(server[1]), {}).get("resolved", 0)
+               > DNS_CACHE_TTL_MINUTES * 60]
+
+    def record_addresses(server, addresses):
+        if addresses:
+            dns_cache[vpn_server_hostname(server[1])] = {"addresses": addresses, "resolved": time.time()}
+
+    if expired:
+        probe_servers_threaded([server[:2] for server in expired], resolve_host, record_addresses, concurrency,
+                               deadline)
+        save_json_file(state_path(DNS_CACHE_FILE), dns_cache)
+    addresses = {}
+    for server in servers:
+        entry = dns_cache.get(vpn_server_hostname(server[1]))
+        if entry and entry["addresses"]:
+            addresses[server[1]] = entry["addresses"][0]
+    return addresses
+
+
+def uplink_options(server):
+    """
+    Return the probe keyword arguments to send the probe of a (location, server id, uplink) server over its uplink
+    """
+    return {"interface": server[2]} if len(server) > 2 and server[2] else {}
 
 
-def debian_service_manager(service, action):
+def probe_target(server, addresses=None):
     """
-    Start or stop Debian based OS service
+    Return the address to probe for a server, the hostname if it was not resolved up front
     """
-    print()
-    task_info(f"Running command to {action} {service} service...")
-    run_command(f'systemctl {action} {service}')
+    if addresses and server[1] in addresses:
+        return addresses[server[1]]
+    return vpn_server_hostname(server[1])
 
 
-def pfsense_service_manager(client_number, action):
+def ping_source_options(interface):
     """
-    Restart openvpn on pfsense server
+    Return ping command options to send from an interface. Linux ping accepts an interface name,
+    other systems need the interface address.
     """
-    print()
-    task_info(f"Running command to {action} pfsense openvpn service...")
-    run_command(
-        f'/usr/local/sbin/pfSsh.php playback svc {action} openvpn client {client_number}')
+    if not interface:
+        return []
+    if sys.platform.startswith("linux"):
+        return ["-I", interface]
+    return ["-S", interface_address(interface)]
 
 
-def debian_service_status(service):
+def ping_server(host, interface=None):
     """
-    Check if service is active or inactive
+    Ping a host once using the system ping command and return the round trip time in ms or None
     """
-    print()
-    task_info("Checking OpenVPN service status")
-    status = run_command_shell(f'systemctl is-active {service}')
-    if status:
-        task_info(f'The {service} service status is: {status}')
-    else:
-        task_error(f'Unable to get status of {service} service')
-    return status
+    source = " ".join(ping_source_options(interface))
+    cmd = str("ping -c 1 -q -s 16 -W 1 " + source + " " + host +
+              " 2> /dev/null | awk -F'/' '/avg/{print $5}'")
+    ping_result = run_command_shell(cmd)
+    if ping_result:
+        return float(ping_result)
+    return None
 
 
-def check_connection(host, port):
+async def ping_server_async(host, interface=None):
     """
-    Check connection to hosts and ports using socket module. Used by check_internet()
+    Asyncio version of ping_server() using a non-blocking subprocess
     """
+    process = await asyncio.create_subprocess_exec(
+        "ping", "-c", "1", "-q", "-s", "16", "-W", "1", *ping_source_options(interface), host,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
     try:
-        task_start(f"Testing connection to {host} on port: {port}")
-        socket.setdefaulttimeout(3)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        task_pass()
-        return True
-    except socket.error as e:
-        task_fail()
-        task_error(e)
+        output, _ = await process.communicate()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    # Linux prints rtt min/avg/max/mdev, FreeBSD prints round-trip min/avg/max/stddev
+    match = re.search(r'= [\d\.]+/([\d\.]+)/', str(output, 'utf-8'))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def icmp_checksum(data):
+    """
+    Return the internet checksum (RFC 1071) of data
+    """
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(data[i] << 8 | data[i + 1] for i in range(0, len(data), 2))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def icmp_echo_packet(ident, sequence):
+    """
+    Build an ICMP echo request with a 16 byte payload to match the ping -s 16 probe
+    """
+    payload = b'ovpnmanager-prb\x00'
+    header = bytes([ICMP_ECHO_REQUEST, 0, 0, 0, ident >> 8, ident & 0xff, sequence >> 8, sequence & 0xff])
+    checksum = icmp_checksum(header + payload)
+    return header[:2] + bytes([checksum >> 8, checksum & 0xff]) + header[4:] + payload
+
+
+def icmp_reply_matches(data, raw, ident, sequence):
+    """
+    Check if a received packet is the echo reply for our request.
+    Raw sockets include the IP header and see every ICMP packet so the identifier is checked.
+    Datagram sockets have the identifier rewritten and filtered by the kernel.
+    """
+    if raw:
+        data = data[(data[0] & 0x0f) * 4:]
+    if len(data) < 8 or data[0] != ICMP_ECHO_REPLY:
         return False
+    if raw and (data[4] << 8 | data[5]) != ident:
+        return False
+    return (data[6] << 8 | data[7]) == sequence
 
 
-def check_internet():
+def interface_address(interface):
     """
-    Use check_connection() to determine Internet connectity. Exit program if check fails.
+    Return the IPv4 address of an interface without any output. Results are cached.
     """
-    task_info("Testing Internet connectivity...")
-    if check_connection("1.1.1.1", 53) and check_connection("google.com", 80):
-        ip_info = get_ip_info()
-        return ip_info
+    if interface not in INTERFACE_ADDRESSES:
+        output = run_command_shell(f'ifconfig {shlex.quote(interface)} 2> /dev/null')
+        match = re.search(r'inet (?:addr:)?([\d\.]+)', output)
+        if not match:
+            raise OSError(f"No IP address found for interface {interface}")
+        INTERFACE_ADDRESSES[interface] = match.group(1)
+    return INTERFACE_ADDRESSES[interface]
+
+
+def bind_to_interface(sock, interface):
+    """
+    Bind a socket to a network interface so probes are sent out that interface instead of following
+    the VPN tunnel routes. Linux uses SO_BINDTODEVICE, other systems bind to the interface address.
+    """
+    if not interface:
+        return
+    if sys.platform.startswith("linux"):
+        # SO_BINDTODEVICE is only exposed by the socket module from Python 3.7 on some builds
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_BINDTODEVICE", 25), interface.encode() + b'\x00')
     else:
-        task_error('You cannot continue without a Internet connection.')
-        sys.exit(1)
+        sock.bind((interface_address(interface), 0))
 
 
-def get_ip_info(address=None):
+def icmp_socket(raw, interface=None):
     """
-    Get public IP address using ipinfo.io and sockets module to resolve hostname
-    An signup api access code may be required depending on usage.
-    Will only show VPN IP if the OpenVPN interface is the default route of all traffic
-    Otherwise your normal service provider WAN IP will be displayed.
+    Open an ICMP socket. Unprivileged datagram sockets require net.ipv4.ping_group_range
+    to include our group, raw sockets require root.
     """
-    print()
-    task_start("Fetching IP info from ipinfo.io")
+    sock_type = socket.SOCK_RAW if raw else socket.SOCK_DGRAM
+    sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
     try:
-        if address:
-            ip_info = json.load(urlopen(f'http://ipinfo.io/{address}/json'))
-        else:
-            ip_info = json.load(urlopen(f'http://ipinfo.io/json'))
-        ip_address = ip_info['ip']
-        ip_city = ip_info['city']
-        ip_country = ip_info['country']
-        task_pass()
-        task_info(
-            f'IP Address: {TermShow.UNDERLINE}{ip_address}{TermShow.RESET} - City: {ip_city} - Country: {ip_country}')
-        return ip_address
-    except Exception as e:
-        task_fail()
-        task_error(e)
-        return e
+        bind_to_interface(sock, interface)
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
 
-def get_interface_ip(interface):
+def icmp_ping(host, raw=False, timeout=PROBE_TIMEOUT, interface=None):
     """
-    Get an interface IP address
+    Send one ICMP echo request from inside Python and return the round trip time in ms or None
     """
-    print()
-    task_start(f"Finding IP address of {interface} using ifconfig")
-    ip_address = run_command_shell(
-        f'ifconfig {interface} | grep \'inet\' | awk \'$1 == "inet" {{ print $2 }}\'').rstrip()
-    if ip_address:
-        task_pass()
-        task_info(f"IP address for {interface} is: {ip_address}")
-        return ip_address
-    else:
-        task_fail()
-        task_error(f"No IP address details found for {interface}")
+    address = socket.gethostbyname(host)
+    ident = random.randint(0, 0xffff)
+    sequence = random.randint(0, 0xffff)
+    with icmp_socket(raw, interface) as sock:
+        sent = time.monotonic()
+        sock.sendto(icmp_echo_packet(ident, sequence), (address, 0))
+        while True:
+            remaining = timeout - (time.monotonic() - sent)
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+            try:
+                data, reply_address = sock.recvfrom(1024)
+            except socket.timeout:
+                return None
+            if reply_address[0] == address and icmp_reply_matches(data, raw, ident, sequence):
+                return (time.monotonic() - sent) * 1000
+
+
+async def icmp_ping_async(host, raw=False, timeout=PROBE_TIMEOUT, interface=None):
+    """
+    Asyncio version of icmp_ping() using a non-blocking socket watched by the event loop
+    """
+    loop = asyncio.get_event_loop()
+    address = (await loop.getaddrinfo(host, None, family=socket.AF_INET))[0][4][0]
+    ident = random.randint(0, 0xffff)
+    sequence = random.randint(0, 0xffff)
+    reply = loop.create_future()
+    with icmp_socket(raw, interface) as sock:
+        sock.setblocking(False)
+
+        def read_reply():
+            try:
+                data, reply_address = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not reply.done() and reply_address[0] == address and \
+                    icmp_reply_matches(data, raw, ident, sequence):
+                reply.set_result(time.monotonic())
+
+        loop.add_reader(sock.fileno(), read_reply)
+        try:
+            sent = time.monotonic()
+            sock.sendto(icmp_echo_packet(ident, sequence), (address, 0))
+            received = await asyncio.wait_for(reply, timeout)
+            return (received - sent) * 1000
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            loop.remove_reader(sock.fileno())
 
 
-def check_config_exists(filename):
-    print()
-    task_start(f'Checking for config file: {filename}')
-    if not os.path.isfile(filename):
-        task_fail()
-        task_error(f'\nConfig file {filename} does not exist.\n')
-        sys.exit(1)
+def tcp_ping(host, port=TCP_PROBE_PORT, timeout=PROBE_TIMEOUT, interface=None):
+    """
+    Measure TCP connect time to a host in ms or None if there is no response.
+    A refused connection still measures a full round trip.
+    """
+    address = socket.gethostbyname(host)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        bind_to_interface(sock, interface)
+        start = time.monotonic()
+        sock.connect((address, port))
+    except ConnectionRefusedError:
+        pass
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    return (time.monotonic() - start) * 1000
+
+
+async def tcp_ping_async(host, port=TCP_PROBE_PORT, timeout=PROBE_TIMEOUT, interface=None):
+    """
+    Asyncio version of tcp_ping()
+    """
+    loop = asyncio.get_event_loop()
+    address = (await loop.getaddrinfo(host, None, family=socket.AF_INET))[0][4][0]
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setblocking(False)
+        try:
+            bind_to_interface(sock, interface)
+            start = time.monotonic()
+            await asyncio.wait_for(loop.sock_connect(sock, (address, port)), timeout)
+        except ConnectionRefusedError:
+            pass
+        except (OSError, asyncio.TimeoutError):
+            return None
+    return (time.monotonic() - start) * 1000
+
+
+def icmp_raw_ping(host, interface=None):
+    return icmp_ping(host, raw=True, interface=interface)
+
+
+async def icmp_raw_ping_async(host, interface=None):
+    return await icmp_ping_async(host, raw=True, interface=interface)
+
+
+# Probe backends as (probe, asyncio probe). Each probe takes a hostname and optional interface
+# and returns ms or None.
+PROBE_BACKENDS = {
+    "icmp": (icmp_ping, icmp_ping_async),
+    "raw": (icmp_raw_ping, icmp_raw_ping_async),
+    "tcp": (tcp_ping, tcp_ping_async),
+    "ping": (ping_server, ping_server_async),
+}
+
+
+def select_probe_backend(backend="auto"):
+    """
+    Return the name of the probe backend to use. Auto prefers unprivileged ICMP datagram sockets,
+    then raw ICMP sockets and falls back to TCP connect probes.
+    """
+    if backend != "auto":
+        return backend
+    for name, raw in (("icmp", False), ("raw", True)):
+        try:
+            icmp_socket(raw).close()
+            return name
+        except OSError:
+            continue
+    return "tcp"
+
+
+def probe_servers_threaded(servers, probe, on_result, concurrency, deadline, addresses=None, on_not_probed=None):
+    """
+    Probe servers from a thread pool. Results are passed to on_result as each probe completes.
+    Probes still running at the deadline are passed to on_result with a result of None. Servers not
+    probed yet are passed to on_not_probed if given, otherwise to on_result with a result of None.
+    Servers in addresses are probed by address instead of hostname and servers with an uplink
+    are probed over that interface.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    futures = {executor.submit(probe, probe_target(server, addresses), **uplink_options(server)): server
+               for server in servers}
+    pending = set(futures)
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=deadline):
+            pending.discard(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                task_error(e)
+                result = None
+            on_result(futures[future], result)
+    except concurrent.futures.TimeoutError:
+        task_error(f"Probe deadline of {deadline} seconds reached with {len(pending)} servers outstanding")
+        for future in pending:
+            if future.cancel() and on_not_probed:
+                on_not_probed(futures[future])
+            else:
+                on_result(futures[future], None)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def probe_servers_asyncio(servers, probe_async, on_result, concurrency, deadline, addresses=None,
+                          on_not_probed=None):
+    """
+    Probe servers from an asyncio event loop. Results are passed to on_result as each probe completes.
+    Probes still running at the deadline are passed to on_result with a result of None. Servers not
+    probed yet are passed to on_not_probed if given, otherwise to on_result with a result of None.
+    Servers in addresses are probed by address instead of hostname.
+    """
+    async def run_probes():
+        semaphore = asyncio.Semaphore(concurrency)
+        started = set()
+
+        async def limited_probe(server):
+            async with semaphore:
+                started.add(server)
+                try:
+                    return server, await probe_async(probe_target(server, addresses), **uplink_options(server))
+                except Exception as e:
+                    task_error(e)
+                    return server, None
+
+        tasks = [asyncio.ensure_future(limited_probe(server)) for server in servers]
+        remaining = set(servers)
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=deadline):
+                server, result = await next_done
+                remaining.discard(server)
+                on_result(server, result)
+        except asyncio.TimeoutError:
+            task_error(f"Probe deadline of {deadline} seconds reached with {len(remaining)} servers outstanding")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for server in servers:
+                if server in remaining and server not in started and on_not_probed:
+                    on_not_probed(server)
+                elif server in remaining:
+                    on_result(server, None)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_probes())
+    finally:
+        loop.close()
+
+
+def probe_servers(servers, on_result, probe_mode="thread", concurrency=10, deadline=10, probe_backend="auto",
+                  interface=None, addresses=None, on_not_probed=None):
+    """
+    Probe servers concurrently using the selected probe mode (thread or asyncio) and probe backend.
+    If an interface is given all probes are sent from that interface.
+    Servers resolved up front in addresses are probed by address so DNS time is not measured.
+    Servers not probed before the deadline are passed to on_not_probed if given.
+    Called by vpn_server_ping()
+    """
+    probe, probe_async = PROBE_BACKENDS[select_probe_backend(probe_backend)]
+    if interface:
+        probe = functools.partial(probe, interface=interface)
+        probe_async = functools.partial(probe_async, interface=interface)
+    if probe_mode == "asyncio":
+        probe_servers_asyncio(servers, probe_async, on_result, concurrency, deadline, addresses, on_not_probed)
     else:
-        task_pass()
+        probe_servers_threaded(servers, probe, on_result, concurrency, deadline, addresses, on_not_probed)
 
 
-def wait_for(seconds):
-    """
-    Wait for number of seconds.
-    """
-    width = 10
-    bar_movement = width / (seconds*10)
-    x = bar_movement
-    second_count = 0
-    for i in range(0, seconds*10):
-        x += bar_movement
-        if i % 10 == 0:
-       	    second_count += 1
-        wait = seconds - (second_count) + 1
-        bar_full = "-" * (width - int(x))
-        bar_part = "#" * int(x)
-        task_start(f"Waiting for {wait} seconds [{bar_part}{bar_full}]")
-        time.sleep(0.1)
-        print(f"\r{' '*40}", end="")
-    print("\r[+] The wait is over", end="")
-    task_pass()
+NO_RESPONSE_PING = 999
+DEFAULT_SCORE_WEIGHTS = {"median": 1.0, "p90": 0.0, "jitter": 1.0, "loss": 500.0,
+                         "connect": 0.5, "handshake": 0.5, "throughput": 2.0, "transport": 0.5}
 
 
-def main():
+def rate_ping(ping_result):
     """
-    Main function to run program.
+    Return rating and display colour for a ping result or latency score in ms
     """
-    show_header()
-    show_banner()
-    block_heading(f"IPVANISH OVPNMANGER STARTING {get_date()}")
-    options = get_arguments()
-    check_user()
-    server_os = check_os()
-    server_count = options.servers
-    server_filter = options.filter
-    if server_os == "debian":
-        # Config filename may need to be changed depending on setup
-        #ovpn_config_file = "testconfig.conf"
-        ovpn_config_file = "/etc/openvpn/client.conf"
-        check_config_exists(ovpn_config_file)
-        check_internet()
-        debian_service_manager("openvpn", "stop")
-        wait_for(5)
-        vpn_server_rank(server_count, server_filter)
-        new_server = vpn_server_random()
-        update_openvpn_config(ovpn_config_file, new_server)
-        debian_service_manager("openvpn", "start")
-        wait_for(10)
-        check_internet()
-    elif server_os == "pfsense":
-        pfsense_config_file = "/cf/conf/config.xml"
-        check_config_exists(pfsense_config_file)
-        check_internet()
-        vpn_server_rank(server_count, server_filter)
-        new_server = vpn_server_random()
-        update_openvpn_config(pfsense_config_file, new_server)
-        # Workaround until issue with old server caching can be fixed.
-        # Number before restart will need to be changed depending on config file name
-        # in /var/etc/openvpn/clientx.conf
-        pfsense_service_manager("2", "restart")
-        wait_for(5)
-        pfsense_service_manager("2", "restart")
-        wait_for(5)
-        pfsense_service_manager("2", "restart")
+    if ping_result >= NO_RESPONSE_PING:
+        return 'NO RESPONSE', TermShow.RED
+    elif ping_result <= 150:
+        return 'EXCELLENT', TermShow.BRGREEN
+    elif ping_result <= 200:
+        return 'GOOD', TermShow.GREEN
+    elif ping_result <= 250:
+        return 'AVERAGE', TermShow.YELLOW
+    return 'POOR', TermShow.BRRED
+
+
+def parse_score_weights(text):
+    """
+    Parse score weights such as "median=1,jitter=2,loss=500" into a dictionary.
+    The connect, handshake and throughput weights are used by the finalist stage and the transport
+    weight by the transport stage.
+    Weights not specified keep their default value.
+    """
+    weights = dict(DEFAULT_SCORE_WEIGHTS)
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip().lower()
+        if name not in weights:
+            raise ValueError(f"Unknown score weight {name}")
+        weights[name] = float(value)
+    return weights
+
+
+def latency_stats(samples, attempts, score_weights=None):
+    """
+    Calculate min, median, p90, jitter (standard deviation) and loss ratio from ping samples in ms
+    and combine them into a single weighted score used for ranking and rating.
+    """
+    weights = score_weights or DEFAULT_SCORE_WEIGHTS
+    loss = 1 - len(samples) / attempts if attempts else 1.0
+    if not samples:
+        return {"samples": 0, "min": None, "median": None, "p90": None, "jitter": None,
+                "loss": loss, "score": float(NO_RESPONSE_PING)}
+    ordered = sorted(samples)
+    p90 = ordered[min(len(ordered) - 1, int(math.ceil(0.9 * len(ordered))) - 1)]
+    stats = {
+        "samples": len(samples),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "p90": p90,
+        "jitter": statistics.pstdev(ordered),
+        "loss": loss,
+    }
+    score = sum(weights[name] * stats[name] for name in ("median", "p90", "jitter", "loss"))
+    stats["score"] = min(score, float(NO_RESPONSE_PING))
+    return stats
+
+
+HISTORY_DB_FILE = "vpn_server_history.db"
+HISTORY_MAX_AGE_DAYS = 30
+
+
+def open_history_db():
+    """
+    Open the probe history database, creating it if required
+    """
+    connection = sqlite3.connect(state_path(HISTORY_DB_FILE))
+    connection.execute("CREATE TABLE IF NOT EXISTS probes "
+                       "(server_id TEXT NOT NULL, location TEXT, probed REAL NOT NULL, rtt REAL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS probes_server ON probes (server_id, probed)")
+    return connection
+
+
+def record_history(probe_samples):
+    """
+    Store probe results as (server_id, location, timestamp, rtt) rows with rtt None for no response.
+    Rows older than HISTORY_MAX_AGE_DAYS are removed.
+    """
+    try:
+        connection = open_history_db()
+        with connection:
+            connection.executemany("INSERT INTO probes VALUES (?, ?, ?, ?)", probe_samples)
+            connection.execute("DELETE FROM probes WHERE probed < ?",
+                               (time.time() - HISTORY_MAX_AGE_DAYS * 86400,))
+        connection.close()
+    except sqlite3.Error as e:
+        task_error(f"Unable to record probe history in {HISTORY_DB_FILE}. {e}")
+
+
+def load_history_scores(half_life=24, score_weights=None):
+    """
+    Return a dictionary of server id to exponentially decayed latency statistics from previous runs.
+    A probe half_life hours old counts half as much as a probe taken now.
+    """
+    weights = score_weights or DEFAULT_SCORE_WEIGHTS
+    now = time.time()
+    history_scores = {}
+    try:
+        connection = open_history_db()
+        # Aggregate in SQLite so only one row per server is returned
+        connection.create_function("decay", 1, lambda probed: 0.5 ** (max(0, now - probed) / (half_life * 3600)))
+        rows = connection.execute(
+            "SELECT server_id, SUM(weight), SUM(CASE WHEN rtt IS NULL THEN 0 ELSE weight END), "
+            "TOTAL(weight * rtt), TOTAL(weight * rtt * rtt) "
+            "FROM (SELECT server_id, rtt, decay(probed) AS weight FROM probes WHERE probed >= ?) "
+            "GROUP BY server_id", (now - HISTORY_MAX_AGE_DAYS * 86400,)).fetchall()
+        connection.close()
+    except sqlite3.Error as e:
+        task_error(f"Unable to read probe history from {HISTORY_DB_FILE}. {e}")
+        return history_scores
+    history = {server_id: {"weight": weight, "rtt_weight": rtt_weight, "rtt": rtt, "rtt_sq": rtt_sq}
+               for server_id, weight, rtt_weight, rtt, rtt_sq in rows if weight}
+    for server_id, server in history.items():
+        loss = 1 - server["rtt_weight"] / server["weight"]
+        if not server["rtt_weight"]:
+            score = float(NO_RESPONSE_PING)
+            mean = jitter = None
+        else:
+            mean = server["rtt"] / server["rtt_weight"]
+            jitter = math.sqrt(max(0.0, server["rtt_sq"] / server["rtt_weight"] - mean * mean))
+            score = min(float(NO_RESPONSE_PING), weights["median"] * mean + weights["p90"] * (mean + jitter) +
+                        weights["jitter"] * jitter + weights["loss"] * loss)
+        history_scores[server_id] = {"mean": mean, "jitter": jitter, "loss": loss,
+                                     "score": score, "weight": server["weight"]}
+    return history_scores
+
+
+def select_candidates(vpn_server_list, count, history_scores, explore=0.3, ordered=False):
+    """
+    Pick servers to probe. The best servers from history fill (1 - explore) of the list,
+    the remainder are picked at random so new servers are still discovered.
+    If the server list is ordered (nearest first) the remainder is taken in order instead.
+    """
+    count = min(count, len(vpn_server_list))
+    known = sorted((server for server in vpn_server_list if server[1] in history_scores),
+                   key=lambda server: history_scores[server[1]]["score"])
+    exploit_count = min(len(known), int(round(count * (1 - explore))))
+    candidates = known[:exploit_count]
+    chosen = set(candidates)
+    others = [server for server in vpn_server_list if server not in chosen]
+    if ordered:
+        candidates += others[:count - exploit_count]
+    else:
+        candidates += random.sample(others, count - exploit_count)
+    return candidates
+
+
+GEO_CACHE_FILE = "vpn_server_locations.json"
+HOST_LOCATION_TTL_DAYS = 7
+
+
+def parse_location(location):
+    """
+    Parse a "latitude,longitude" string such as the ipinfo.io loc field
+    """
+    latitude, longitude = (float(value) for value in location.split(","))
+    return latitude, longitude
+
+
+def distance_km(origin, destination):
+    """
+    Great circle (haversine) distance in km between two (latitude, longitude) points
+    """
+    lat1, lon1, lat2, lon2 = (math.radians(value) for value in origin + destination)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * math.asin(math.sqrt(a))
+
+
+def load_geo_cache():
+    """
+    Load the cached host location and server city code coordinates
+    """
+    try:
+        with open(state_path(GEO_CACHE_FILE)) as cache_file:
+            geo = json.load(cache_file)
+        if isinstance(geo.get("cities"), dict):
+            return geo
+    except (OSError, ValueError):
+        pass
+    return {"host": None, "cities": {}}
+
+
+def host_location(geo, location=None):
+    """
+    Return our (latitude, longitude) from the location option, the cache or ipinfo.io.
+    Looked up with the tunnel up this is the VPN server location, so the cached location is kept
+    for HOST_LOCATION_TTL_DAYS and can be set with the location option instead.
+    """
+    if location:
+        return parse_location(location)
+    host = geo.get("host")
+    if host and time.time() - host.get("fetched", 0) < HOST_LOCATION_TTL_DAYS * 86400:
+        return tuple(host["location"])
+    try:
+        ip_info = fetch_ip_info()
+        geo["host"] = {"location": parse_location(ip_info["loc"]), "fetched": time.time()}
+        return tuple(geo["host"]["location"])
+    except Exception as e:
+        task_error(f"Unable to get host location from ipinfo.io. {e}")
+        return tuple(host["location"]) if host else None
+
+
+def lookup_city_locations(geo, vpn_server_list, max_lookups=20):
+    """
+    Add coordinates for city codes not in the cache by looking up the address of one server
+    per city on ipinfo.io. At most max_lookups cities are looked up per run.
+    """
+    cities = geo["cities"]
+    missing = {}
+    for server in vpn_server_list:
+        city_code = server[1].split("-")[0]
+        if city_code not in cities and city_code not in missing:
+            missing[city_code] = server
+    lookups = list(missing.values())[:max_lookups]
+    if not lookups:
+        return
+    task_info(f"Looking up coordinates of {len(lookups)} of {len(missing)} new server cities")
+
+    def lookup(host):
+        return parse_location(cached_ip_info(socket.gethostbyname(host))["loc"])
+
+    def record_location(server, location):
+        if location:
+            cities[server[1].split("-")[0]] = location
+
+    probe_servers_threaded(lookups, lookup, record_location, 5, 30)
+
+
+def geo_preselect(vpn_server_list, max_lookups=20, location=None):
+    """
+    Order servers nearest first using the cached city coordinates and our location.
+    Servers in cities without coordinates are put last in random order.
+    """
+    geo = load_geo_cache()
+    origin = host_location(geo, location)
+    lookup_city_locations(geo, vpn_server_list, max_lookups)
+    save_json_file(state_path(GEO_CACHE_FILE), geo)
+    if not origin:
+        task_error("No host location available. Servers are selected at random.")
+        return vpn_server_list, False
+    cities = geo["cities"]
+
+    def distance(server):
+        city = cities.get(server[1].split("-")[0])
+        return distance_km(origin, tuple(city)) if city else float("inf")
+
+    ordered = sorted(random.sample(vpn_server_list, len(vpn_server_list)), key=distance)
+    nearest = distance(ordered[0]) if ordered else float("inf")
+    if nearest != float("inf"):
+        task_info(f"Nearest server city {ordered[0][0]} is {nearest:.0f}km away")
+    return ordered, True
+
+
+def blend_history(stats, history, history_weight=0.3):
+    """
+    Blend current latency statistics with the decayed history score for the server
+    """
+    stats["current_score"] = stats["score"]
+    if history and history_weight > 0:
+        stats["history_score"] = history["score"]
+        stats["score"] = (1 - history_weight) * stats["score"] + history_weight * history["score"]
+    return stats
+
+
+def run_tournament(servers, probe_round, server_score, probe_budget, keep=5):
+    """
+    Successive halving tournament. Every server gets one cheap probe, then the better half is
+    re-probed with more samples each round until keep servers remain or the probe budget is spent.
+    probe_round(servers, samples) probes each server samples times and returns False if the deadline
+    was reached. server_score(server) returns the current score of a server.
+    Returns a dictionary of server to the last round it was probed in.
+    """
+    survivors = list(servers)
+    rounds_reached = {}
+    budget = probe_budget
+    planned_rounds = 1 + max(0, int(math.ceil(math.log2(max(1, len(survivors) / keep)))))
+    round_number = 1
+    samples = 1
+    while survivors and budget >= len(survivors):
+        task_info(f"Tournament round {round_number}: probing {len(survivors)} servers "
+                  f"with {samples} samples each")
+        completed = probe_round(survivors, samples)
+        budget -= samples * len(survivors)
+        for server in survivors:
+            rounds_reached[server] = round_number
+        if not completed or len(survivors) <= keep:
+            break
+        survivors = sorted(survivors, key=server_score)[:max(keep, len(survivors) // 2)]
+        round_number += 1
+        rounds_left = max(1, planned_rounds - round_number + 1)
+        samples = max(1, (budget // rounds_left) // len(survivors))
+    return rounds_reached
+
+
+def vpn_server_ping(server_count, server_filter, probe_mode="thread", concurrency=10, deadline=10,
+                    probe_backend="auto", samples=3, score_weights=None, catalog_ttl=24,
+                    history_half_life=24, history_weight=0.3, explore=0.3, strategy="sample", probe_budget=300,
+                    interface=None, geo=False, geo_lookups=20, location=None, uplinks=None):
+    """
+    Ping IPVanish servers concurrently and rate based on ping latency statistics.
+    Each server is sent samples probes in rounds so probes to the same server are never sent together.
+    The tournament strategy probes a wide set of servers once and re-probes only the best within probe_budget.
+    If an interface is given probes are bound to it so they bypass an active VPN tunnel.
+    With geo the servers nearest to our location are probed instead of a random selection.
+    With uplinks every server is probed over each uplink interface and ranked as (server, uplink) pairs.
+    Results are stored in the probe history and blended with the history of previous runs.
+    Called by vpn_server_rank()
+    """
+    print()
+    vpn_server_list = []
+    with timed_phase("catalog"):
+        vpn_server_list = fetch_server_configs(server_filter, catalog_ttl)
+    task_info(f"Total servers found: {len(vpn_server_list)}")
+    if strategy == "tournament":
+        # Spend up to half the budget on the first round, the rest on the survivors
+        number_of_servers = min(len(vpn_server_list), max(1, probe_budget // 2 // len(uplinks or [None])))
+    else:
+        number_of_servers = min(server_count, len(vpn_server_list))
+    history_scores = load_history_scores(history_half_life, score_weights)
+    ordered = False
+    if geo:
+        vpn_server_list, ordered = geo_preselect(vpn_server_list, geo_lookups, location)
+    random_server_list = select_candidates(vpn_server_list, number_of_servers, history_scores, explore, ordered)
+    known_count = sum(1 for server in random_server_list if server[1] in history_scores)
+    if known_count:
+        task_info(f"Selected {known_count} servers from probe history and {number_of_servers - known_count} new servers")
+    probe_backend = select_probe_backend(probe_backend)
+    if strategy == "tournament":
+        task_info(f"Using {probe_backend} probe backend with a tournament budget of {probe_budget} probes")
+    else:
+        task_info(f"Using {probe_backend} probe backend with {samples} samples per server")
+    if interface:
+        task_info(f"Sending probes from interface {interface}")
+    with timed_phase("resolve"):
+        addresses = resolve_servers(random_server_list, concurrency, deadline)
+    task_info(f"Resolved {len(addresses)} of {len(random_server_list)} server addresses")
+    column_widths = [4, 14, 8, 6, 6, 5, 6, 10]
+    column_labels = ["No.", "LOCATION", "SERVER", "PING", "JITTER", "LOSS", "SCORE", "RATING"]
+    if uplinks:
+        task_info(f"Probing every server over uplinks {', '.join(uplinks)}")
+        # Probe (server, uplink) pairs from one pool so uplinks are probed concurrently
+        random_server_list = [server + (uplink,) for server in random_server_list for uplink in uplinks]
+        column_widths.insert(3, 8)
+        column_labels.insert(3, "UPLINK")
+    print(f"\n{len(random_server_list)} VPN server ping response times...")
+
+    def show_table_header():
+        table_decorator(column_widths, "+", "-")
+        table_row_data(column_widths, column_labels)
+        table_decorator(column_widths, "+", "=")
+
+    vpn_server_results = []
+    finished_servers = set()
+    server_samples = {server: [] for server in random_server_list}
+    server_attempts = dict.fromkeys(random_server_list, 0)
+    probe_history = []
+
+    def record_sample(vpn_server, ping_result):
+        server_attempts[vpn_server] += 1
+        probe_history.append((vpn_server[1], vpn_server[0], time.time(), ping_result))
+        RUN_RECORD.setdefault("probes", []).append([vpn_server[1], ping_result])
+        if ping_result is not None:
+            server_samples[vpn_server].append(ping_result)
+
+    def server_stats(vpn_server):
+        stats = latency_stats(server_samples[vpn_server], server_attempts[vpn_server], score_weights)
+        return blend_history(stats, history_scores.get(vpn_server[1]), history_weight)
+
+    def finish_server(vpn_server, rounds=1, show=True):
+        server_location = vpn_server[0]
+        server_id = vpn_server[1]
+        stats = server_stats(vpn_server)
+        stats["rounds"] = rounds
+        if len(vpn_server) > 2:
+            stats["uplink"] = vpn_server[2]
+        finished_servers.add(vpn_server)
+        ping_rating, result_color = rate_ping(stats["score"])
+        if stats["samples"]:
+            ping_result = int(stats["median"])
+            jitter = f'{stats["jitter"]:.0f}ms'
+        else:
+            # Add 999 if no response to prevent problems with sort.
+            ping_result = NO_RESPONSE_PING
+            jitter = "-"
+        count = len(vpn_server_results) + 1
+        result_data = [str(count), str(server_location).upper(), server_id, str(ping_result) + "ms", jitter,
+                       f'{stats["loss"]:.0%}', f'{stats["score"]:.0f}', ping_rating]
+        if uplinks:
+            result_data.insert(3, vpn_server[2])
+        if show:
+            table_row_data(column_widths, result_data, result_color)
+        vpn_server_results.append(
+            (server_location, server_id, ping_result, ping_rating, stats))
+
+    def record_result(vpn_server, ping_result):
+        record_sample(vpn_server, ping_result)
+        finish_server(vpn_server)
+
+    probe_end = time.monotonic() + deadline
+
+    def probe_round(vpn_servers, rounds, on_last_result=record_sample):
+        # Interleave samples by probing every server once per round
+        for sample in range(rounds):
+            remaining = probe_end - time.monotonic()
+            if remaining <= 0:
+                task_error(f"Probe deadline of {deadline} seconds reached")
+                return False
+            last_round = sample == rounds - 1
+            # A probe that was never sent says nothing about the server so it is not recorded
+            probe_servers(vpn_servers, on_last_result if last_round else record_sample,
+                          probe_mode, concurrency, remaining, probe_backend, interface, addresses,
+                          on_not_probed=lambda vpn_server: None)
+        return True
+
+    with timed_phase("probe"):
+        if strategy == "tournament":
+            rounds_reached = run_tournament(random_server_list, probe_round,
+                                            lambda vpn_server: server_stats(vpn_server)["score"], probe_budget)
+            show_table_header()
+            final_round = max(rounds_reached.values(), default=1)
+            eliminated = 0
+            for vpn_server in sorted(rounds_reached, key=lambda server: (-rounds_reached[server],
+                                                                          server_stats(server)["score"])):
+                rounds = rounds_reached[vpn_server]
+                # Only show servers that made it past the first round
+                show = rounds > 1 or final_round == 1
+                eliminated += not show
+                finish_server(vpn_server, rounds, show)
+            if eliminated:
+                print(f"{'':2}{eliminated} servers eliminated in the first round are not shown")
+        else:
+            show_table_header()
+            probe_round(random_server_list, samples, record_result)
+        for vpn_server in random_server_list:
+            if vpn_server not in finished_servers:
+                finish_server(vpn_server)
+    table_decorator(column_widths, "+", "-")
+    record_history(probe_history)
+    print()
+    return vpn_server_results
+
+
+def bandwidth_probe(host, port=443, timeout=5, path="/", max_bytes=1048576, interface=None):
+    """
+    Measure TCP connect time and TLS handshake time in ms and download throughput in Mbit/s from a server.
+    Throughput is only measured when the server answers an HTTPS request for path. Stages that do not
+    complete are None. The whole probe is limited to timeout seconds.
+    """
+    result = {"connect": None, "handshake": None, "throughput": None}
+    end_time = time.monotonic() + timeout
+    address = socket.gethostbyname(host)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        bind_to_interface(sock, interface)
+        sock.settimeout(timeout)
+        start = time.monotonic()
+        sock.connect((address, port))
+        result["connect"] = (time.monotonic() - start) * 1000
+        # Only the handshake time is wanted, the certificate is not verified
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        sock.settimeout(max(0.01, end_time - time.monotonic()))
+        start = time.monotonic()
+        sock = context.wrap_socket(sock, server_hostname=host)
+        result["handshake"] = (time.monotonic() - start) * 1000
+        if path:
+            sock.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            received = 0
+            start = time.monotonic()
+            while received < max_bytes and time.monotonic() < end_time:
+                sock.settimeout(max(0.01, end_time - time.monotonic()))
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    break
+                if not data:
+                    break
+                received += len(data)
+            if received:
+                result["throughput"] = received * 8 / max(0.001, time.monotonic() - start) / 1000000
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    return result
+
+
+def finalist_score(stats, bandwidth, score_weights=None):
+    """
+    Add connect and handshake times to a latency score and subtract a bonus per Mbit/s of throughput.
+    A server that does not accept a connection on port 443 gets the no response time as connect time.
+    """
+    weights = score_weights or DEFAULT_SCORE_WEIGHTS
+    connect = bandwidth["connect"] if bandwidth["connect"] is not None else NO_RESPONSE_PING
+    score = stats["score"] + weights["connect"] * connect + weights["handshake"] * (bandwidth["handshake"] or 0)
+    score -= weights["throughput"] * (bandwidth["throughput"] or 0)
+    return max(0.0, score)
+
+
+def measure_finalists(servers_ranked, finalists, finalist_time=5, bandwidth_path="/", interface=None,
+                      concurrency=10, score_weights=None):
+    """
+    Second ranking stage for the top latency finalists. Connect, handshake and throughput are measured
+    on port 443 at the same time for all finalists and limited to finalist_time seconds in total.
+    Returns the ranked list with the finalists re-scored and ranked ahead of the other servers.
+    Finalists that failed the connect or handshake are dropped unless no finalist passed.
+    """
+    finalist_servers = servers_ranked[:finalists]
+    task_info(f"Measuring connect, handshake and throughput of {len(finalist_servers)} finalists "
+              f"(limit {finalist_time} seconds)")
+    bandwidth_results = {}
+    probe = functools.partial(bandwidth_probe, timeout=finalist_time, path=bandwidth_path, interface=interface)
+    probe_servers_threaded([(server[0], server[1], server[4].get("uplink")) for server in finalist_servers], probe,
+                           lambda server, result: bandwidth_results.update({server: result}),
+                           max(1, min(concurrency, len(finalist_servers))), finalist_time + 1)
+    rescored = []
+    for server in finalist_servers:
+        bandwidth = bandwidth_results.get((server[0], server[1], server[4].get("uplink"))) or \
+            {"connect": None, "handshake": None, "throughput": None}
+        stats = dict(server[4], **bandwidth)
+        stats["latency_score"] = stats["score"]
+        stats["score"] = finalist_score(stats, bandwidth, score_weights)
+        # Finalists rank ahead of servers that were not measured in this stage
+        stats["rounds"] += 1
+        rating, _ = rate_ping(stats["score"])
+        rescored.append((server[0], server[1], server[2], rating, stats))
+    passed = [server for server in rescored
+              if server[4]["connect"] is not None and server[4]["handshake"] is not None]
+    if passed:
+        if len(passed) < len(rescored):
+            task_info(f"Dropped {len(rescored) - len(passed)} finalists that failed the connect or handshake")
+        rescored = passed
+    else:
+        task_error("No finalist completed the connect and handshake, keeping the latency ranking")
+    rescored.sort(key=lambda server: server[4]["score"])
+    return rescored + servers_ranked[finalists:]
+
+
+OPENVPN_HARD_RESET_CLIENT_V2 = 7
+OPENVPN_HARD_RESET_SERVER_V2 = 8
+
+
+def openvpn_udp_ping(address, port=443, timeout=PROBE_TIMEOUT, interface=None):
+    """
+    Send an OpenVPN P_CONTROL_HARD_RESET_CLIENT_V2 packet over UDP and return the round trip time in ms
+    of the server hard reset reply, or None. Servers using tls-auth or tls-crypt drop the unsigned packet.
+    """
+    session_id = os.urandom(8)
+    # Opcode and key id, session id, empty ack array and packet id 0
+    packet = bytes([OPENVPN_HARD_RESET_CLIENT_V2 << 3]) + session_id + b"\0" + struct.pack("!I", 0)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            bind_to_interface(sock, interface)
+            sock.settimeout(timeout)
+            start = time.monotonic()
+            end_time = start + timeout
+            sock.sendto(packet, (address, port))
+            while time.monotonic() < end_time:
+                sock.settimeout(max(0.001, end_time - time.monotonic()))
+                data, source = sock.recvfrom(2048)
+                if len(data) < 10 or data[0] >> 3 != OPENVPN_HARD_RESET_SERVER_V2:
+                    continue
+                # The reply acknowledges our packet id with our session id after the ack array
+                acks = data[9]
+                if acks and data[10 + 4 * acks:18 + 4 * acks] != session_id:
+                    continue
+                return (time.monotonic() - start) * 1000
+        except OSError:
+            return None
+    return None
+
+
+def openvpn_tcp_ping(address, port=443, timeout=PROBE_TIMEOUT, interface=None):
+    """
+    Measure TCP connect time in ms to an OpenVPN TCP port or None. Unlike tcp_ping() a refused connection
+    counts as no response because the port is not served.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            bind_to_interface(sock, interface)
+            start = time.monotonic()
+            sock.connect((address, port))
+        except OSError:
+            return None
+    return (time.monotonic() - start) * 1000
+
+
+TRANSPORT_PROBES = {"udp": openvpn_udp_ping, "tcp": openvpn_tcp_ping}
+
+
+def parse_transports(text):
+    """
+    Parse transports such as udp:443,tcp:443 into a list of (proto, port)
+    """
+    transports = []
+    for term in text.lower().split(","):
+        proto, _, port = term.strip().partition(":")
+        if proto not in TRANSPORT_PROBES or not port.isdigit() or not 0 < int(port) < 65536:
+            raise ValueError(f"Invalid transport {term}")
+        transports.append((proto, int(port)))
+    return transports
+
+
+def transport_latency(host, proto, port, samples=3, interface=None):
+    """
+    Return the median handshake round trip time in ms of samples probes of one transport and port, or None
+    """
+    address = resolve_host(host)[0]
+    results = [TRANSPORT_PROBES[proto](address, port, interface=interface) for sample in range(samples)]
+    results = [result for result in results if result is not None]
+    return statistics.median(results) if results else None
+
+
+def measure_transports(servers_ranked, transports, count=5, interface=None, concurrency=10, samples=3,
+                       score_weights=None):
+    """
+    Measure every transport and port of the top count servers at the same time. TCP is measured by
+    connect time and UDP by the round trip of an OpenVPN hard reset. The fastest transport is kept in the
+    stats as proto and port and its handshake time is added to the score with the transport weight.
+    Servers with an answering transport are re-ranked on that score ahead of the servers where no
+    transport answered, which keep the proto and port of the config.
+    """
+    weights = score_weights or DEFAULT_SCORE_WEIGHTS
+    measured_servers = servers_ranked[:count]
+    task_info(f"Measuring {', '.join(f'{proto}:{port}' for proto, port in transports)} handshakes of "
+              f"{len(measured_servers)} servers")
+    jobs = [(index, proto, port) for index in range(len(measured_servers)) for proto, port in transports]
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(jobs)))) as executor:
+        futures = {executor.submit(transport_latency, vpn_server_hostname(measured_servers[index][1]), proto, port,
+                                   samples, measured_servers[index][4].get("uplink") or interface): (index, proto, port)
+                   for index, proto, port in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except (OSError, IndexError) as e:
+                task_error(f"Unable to measure {futures[future][1]}:{futures[future][2]} handshakes. {e}")
+                results[futures[future]] = None
+    answered = []
+    unanswered = []
+    for index, server in enumerate(measured_servers):
+        stats = dict(server[4])
+        stats["transports"] = {f"{proto}:{port}": results.get((index, proto, port)) for proto, port in transports}
+        server_rtts = [(rtt, proto, port) for (job_index, proto, port), rtt in results.items()
+                       if job_index == index and rtt is not None]
+        if not server_rtts:
+            unanswered.append((server[0], server[1], server[2], server[3], stats))
+            continue
+        stats["transport_rtt"], stats["proto"], stats["port"] = min(server_rtts)
+        stats["score"] += weights["transport"] * stats["transport_rtt"]
+        # Servers with an answering transport rank ahead of the servers that were not measured in this stage
+        stats["rounds"] += 1
+        rating, _ = rate_ping(stats["score"])
+        answered.append((server[0], server[1], server[2], rating, stats))
+    if not answered:
+        task_error("No server answered on any transport, keeping the current proto and port")
+    elif unanswered:
+        task_info(f"{len(unanswered)} servers where no transport answered keep the current proto and port")
+    answered.sort(key=lambda server: server[4]["score"])
+    return answered + unanswered + servers_ranked[count:]
+
+
+SHARED_LEASE_MARGIN = 60
+SHARED_POLL_INTERVAL = 1
+
+
+def shared_results_key(server_filter):
+    """
+    Return the key probe results are shared under, nodes only share results for the same server filter
+    """
+    return ",".join(sorted(term.strip() for term in server_filter.lower().split(","))) if server_filter else "all"
+
+
+def shared_result_valid(result):
+    """
+    Return True if a shared probe result has the (location, server id, ping, rating, stats) form
+    of vpn_server_ping() results with a valid server id and the stats used for ranking
+    """
+    number = (int, float)
+    if not isinstance(result, list) or len(result) != 5:
+        return False
+    location, server_id, ping, rating, stats = result
+    if not (isinstance(location, str) and isinstance(server_id, str) and SERVER_ID_PATTERN.fullmatch(server_id)
+            and isinstance(ping, number) and isinstance(rating, str) and isinstance(stats, dict)):
+        return False
+    if not (isinstance(stats.get("samples"), int) and isinstance(stats.get("rounds"), int)
+            and all(isinstance(stats.get(name), number) for name in ("loss", "score"))):
+        return False
+    if stats["samples"] and not all(isinstance(stats.get(name), number) for name in ("min", "median", "p90", "jitter")):
+        return False
+    if any(not isinstance(stats.get(name), number + (type(None),)) for name in ("connect", "handshake", "throughput")):
+        return False
+    return "uplink" not in stats or (isinstance(stats["uplink"], str) and re.fullmatch(r'[\w\.-]+', stats["uplink"]))
+
+
+def shared_record_valid(record):
+    """
+    Return True if a shared results record has a publish time, node name and only valid probe results.
+    Records from other nodes end up in the config file so anything else is ignored.
+    """
+    return (isinstance(record, dict) and isinstance(record.get("published"), (int, float))
+            and isinstance(record.get("node"), str) and isinstance(record.get("results"), list)
+            and all(shared_result_valid(result) for result in record["results"]))
+
+
+def shared_results_load(store, key):
+    """
+    Return the shared probe results record for a key from a shared file or HTTP endpoint, or None.
+    Invalid records are treated as missing.
+    """
+    try:
+        if store.startswith(("http://", "https://")):
+            with urlopen(f"{store.rstrip('/')}/results?{urlencode({'key': key})}", timeout=5) as response:
+                record = json.load(response)
+        else:
+            with open(store) as store_file:
+                records = json.load(store_file)
+            record = records.get(key) if isinstance(records, dict) else None
+        if record is not None and not shared_record_valid(record):
+            task_error(f"Ignoring invalid shared results for {key} in {store}")
+            return None
+        return record
+    except HTTPError as e:
+        if e.code != 404:
+            task_error(f"Unable to read shared results from {store}. {e}")
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            task_error(f"Unable to read shared results from {store}. {e}")
+    return None
+
+
+def shared_results_publish(store, key, vpn_server_results):
+    """
+    Publish probe results to a shared file or HTTP endpoint for other nodes
+    """
+    record = {"published": time.time(), "node": socket.gethostname(), "results": vpn_server_results}
+    try:
+        if store.startswith(("http://", "https://")):
+            request = Request(f"{store.rstrip('/')}/results?{urlencode({'key': key})}",
+                              data=json.dumps(record).encode(), method="PUT",
+                              headers={"Content-Type": "application/json"})
+            with urlopen(request, timeout=5):
+                pass
+        else:
+            try:
+                with open(store) as store_file:
+                    records = json.load(store_file)
+            except (OSError, ValueError):
+                records = {}
+            if not isinstance(records, dict):
+                records = {}
+            records[key] = record
+            write_file_atomic(store, json.dumps(records))
+        task_info(f"Published {len(vpn_server_results)} probe results to {store}")
+    except (OSError, ValueError) as e:
+        task_error(f"Unable to publish shared results to {store}. {e}")
+
+
+@contextlib.contextmanager
+def shared_results_lease(store, key, lease_time):
+    """
+    Hold the probe lease of a key so only one node probes at a time. A shared file is locked with flock
+    on a .lock file next to it, waiting up to lease_time seconds. An HTTP endpoint grants a lease for
+    lease_time seconds without waiting. Yields True if the lease is held.
+    """
+    if store.startswith(("http://", "https://")):
+        try:
+            request = Request(f"{store.rstrip('/')}/lease?{urlencode({'key': key, 'seconds': lease_time})}",
+                              data=b"", method="POST")
+            with urlopen(request, timeout=5) as response:
+                granted = json.load(response).get("granted", False)
+        except (OSError, ValueError) as e:
+            task_error(f"Unable to get a probe lease from {store}. {e}")
+            granted = False
+        yield granted
+        return
+    try:
+        lock_file = open(store + ".lock", "a")
+    except OSError as e:
+        task_error(f"Unable to open shared results lock {store}.lock. {e}")
+        yield False
+        return
+    try:
+        end_time = time.monotonic() + lease_time
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= end_time:
+                    locked = False
+                    break
+                time.sleep(SHARED_POLL_INTERVAL)
+        yield locked
+    finally:
+        lock_file.close()
+
+
+def shared_server_ping(store, ttl, server_filter, lease_time, probe):
+    """
+    Return probe results shared by another node when they are younger than ttl minutes. Otherwise take
+    the probe lease, probe with probe() and publish the results. While another node holds the lease
+    its results are waited for instead of probing the same servers twice.
+    """
+    key = shared_results_key(server_filter)
+
+    def fresh_results():
+        record = shared_results_load(store, key)
+        if record and time.time() - record["published"] < ttl * 60:
+            age = (time.time() - record["published"]) / 60
+            task_info(f"Using {len(record['results'])} probe results shared by {record['node']} "
+                      f"{age:.1f} minutes ago")
+            return [tuple(result) for result in record["results"]]
+        return None
+
+    vpn_server_results = fresh_results()
+    if vpn_server_results is not None:
+        return vpn_server_results
+    with shared_results_lease(store, key, lease_time) as leased:
+        if not leased:
+            task_info("Another node is probing, waiting for its results")
+            end_time = time.monotonic() + lease_time
+            while time.monotonic() < end_time:
+                vpn_server_results = fresh_results()
+                if vpn_server_results is not None:
+                    return vpn_server_results
+                time.sleep(SHARED_POLL_INTERVAL)
+        else:
+            # Another node may have published while the lease was being waited for
+            vpn_server_results = fresh_results()
+            if vpn_server_results is not None:
+                return vpn_server_results
+        vpn_server_results = probe()
+        shared_results_publish(store, key, vpn_server_results)
+    return vpn_server_results
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_shared_results(listen):
+    """
+    Serve shared probe results and probe leases over HTTP for the --shared-results option of other nodes.
+    GET /results returns the results of a key, PUT /results publishes them and POST /lease grants the
+    probe lease of a key when no other node holds it. Results are kept in memory.
+    """
+    records = {}
+    leases = {}
+    lock = threading.Lock()
+
+    class SharedResultsHandler(BaseHTTPRequestHandler):
+        def reply(self, code, data=None):
+            body = json.dumps(data).encode() if data is not None else b""
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def request_key(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            return url.path, query.get("key", ["all"])[0], query
+
+        def do_GET(self):
+            path, key, query = self.request_key()
+            with lock:
+                record = records.get(key)
+            self.reply(200, record) if path == "/results" and record else self.reply(404)
+
+        def do_PUT(self):
+            path, key, query = self.request_key()
+            if path != "/results":
+                return self.reply(404)
+            try:
+                record = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                return self.reply(400)
+            if not shared_record_valid(record):
+                return self.reply(400)
+            with lock:
+                records[key] = record
+                leases.pop(key, None)
+            self.reply(204)
+
+        def do_POST(self):
+            path, key, query = self.request_key()
+            if path != "/lease":
+                return self.reply(404)
+            seconds = float(query.get("seconds", [SHARED_LEASE_MARGIN])[0])
+            with lock:
+                granted = leases.get(key, 0) < time.time()
+                if granted:
+                    leases[key] = time.time() + seconds
+                expires = leases[key]
+            self.reply(200, {"granted": granted, "expires": expires})
+
+        def log_message(self, format, *args):
+            task_info(f"{self.address_string()} {format % args}")
+
+    host, _, port = listen.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), SharedResultsHandler)
+    task_info(f"Serving shared probe results on {host or '127.0.0.1'}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+        task_info("Shared results server stopped")
+    finally:
+        server.server_close()
+
+
+def vpn_server_rank(server_count, server_filter, finalists=0, finalist_time=5, bandwidth_path="/", top_servers=5,
+                    shared_results=None, shared_ttl=15, transports=None, **rank_settings):
+    """
+    Sort IPVanish service list based on latency score and narrow down list to top 5 (or top_servers) and write to file
+    If finalists is set the top servers are re-ranked on connect, handshake and throughput. Finalists
+    are at least twice top_servers so the stage can change which servers are written.
+    With shared_results fresh probe results of another node are used instead of probing.
+    With transports twice the top servers are re-ranked on their fastest OpenVPN transport and port.
+    Calls vpn_server_ping()
+    """
+    vpn_server_results = []
+    if shared_results:
+        lease_time = rank_settings.get("deadline", 10) + SHARED_LEASE_MARGIN
+        vpn_server_results = shared_server_ping(
+            shared_results, shared_ttl, server_filter, lease_time,
+            lambda: vpn_server_ping(server_count, server_filter, **rank_settings))
+    else:
+        vpn_server_results = vpn_server_ping(server_count, server_filter, **rank_settings)
+    top_server_count = top_servers
+    # The random pick is from the top servers so a second stage has to measure more servers to change it
+    stage_count = top_server_count * 2
+    if 0 < finalists < stage_count:
+        task_info(f"Measuring {stage_count} finalists so the finalist stage can change the top {top_server_count}")
+        finalists = stage_count
+    # This sorts list by latency score
+    # Servers that reached a later tournament round rank ahead of servers eliminated earlier
+    servers_ranked = sorted(vpn_server_results, key=lambda server: (-server[4]["rounds"], server[4]["score"]))
+    if finalists > 0:
+        with timed_phase("finalists"):
+            servers_ranked = measure_finalists(servers_ranked, finalists, finalist_time, bandwidth_path,
+                                               rank_settings.get("interface"), rank_settings.get("concurrency", 10),
+                                               rank_settings.get("score_weights"))
+        print(f"\nTop {top_server_count} rated servers based on latency and throughput")
+    else:
+        print(f"Top {top_server_count} rated servers based on latency")
+    uplinks = any("uplink" in server[4] for server in servers_ranked)
+    if uplinks:
+        # Keep the best uplink of each server
+        seen = set()
+        servers_ranked = [server for server in servers_ranked if not (server[1] in seen or seen.add(server[1]))]
+    if transports:
+        with timed_phase("transports"):
+            servers_ranked = measure_transports(servers_ranked, transports, stage_count,
+                                                rank_settings.get("interface"), rank_settings.get("concurrency", 10),
+                                                rank_settings.get("samples", 3), rank_settings.get("score_weights"))
+    # Keep the uplink and transport of the top servers for when the config is updated
+    save_json_file(state_path(RANKED_DETAILS_FILE), {
+        vpn_server_hostname(server[1]): {key: server[4][key] for key in ("uplink", "proto", "port") if key in server[4]}
+        for server in servers_ranked[:top_server_count]})
+    # Write top 10 vpn servers to txt file and display
+    vpn_server_file = open(state_path(RANKED_SERVER_FILE), 'w')
+    count = 1
+    column_widths = [4, 14, 8, 6, 6, 5, 6, 10]
+    column_labels = ["RANK", "LOCATION", "SERVER", "PING", "JITTER", "LOSS", "SCORE", "RATING"]
+    if uplinks:
+        column_widths.insert(3, 8)
+        column_labels.insert(3, "UPLINK")
+    if transports:
+        column_widths += [8, 9]
+        column_labels += ["PROTO", "HANDSHAKE"]
+    if finalists > 0:
+        column_widths += [7, 6, 6]
+        column_labels += ["CONNECT", "TLS", "MBIT/S"]
+    table_decorator(column_widths, "+", "-")
+    table_row_data(column_widths, column_labels)
+    table_decorator(column_widths, "+", "=")
+    for server in servers_ranked[:top_server_count]:
+        server_location = server[0]
+        server_id = server[1]
+        server_ping = server[2]
+        server_rating = server[3]
+        server_stats = server[4]
+        jitter = f'{server_stats["jitter"]:.0f}ms' if server_stats["samples"] else "-"
+        result_data = [str(count), str(server_location).upper(), server_id, str(server_ping) + "ms", jitter,
+                       f'{server_stats["loss"]:.0%}', f'{server_stats["score"]:.0f}', server_rating]
+        if uplinks:
+            result_data.insert(3, server_stats.get("uplink", "-"))
+        if transports:
+            result_data += [f'{server_stats["proto"]}:{server_stats["port"]}' if "proto" in server_stats else "-",
+                            f'{server_stats["transport_rtt"]:.0f}ms' if "proto" in server_stats else "-"]
+        if finalists > 0:
+            result_data += [f'{server_stats[name]:.0f}ms' if server_stats.get(name) is not None else "-"
+                            for name in ("connect", "handshake")]
+            result_data.append(f'{server_stats["throughput"]:.1f}' if server_stats.get("throughput") else "-")
+        table_row_data(column_widths, result_data)
+        full_server_name = vpn_server_hostname(server[1])
+        vpn_server_file.write(full_server_name + "\n")
+        count += 1
+    table_decorator(column_widths, "+", "-")
+    vpn_server_file.close()
+    print()
+    return servers_ranked
+
+
+def vpn_server_random(exclude=None):
+    """
+    Read top 5 server list file and select random server called by update_openvpn_config()
+    The excluded server (normally the current server) is not selected unless it is the only one.
+    """
+    vpn_server_file = open(state_path(RANKED_SERVER_FILE), 'r')
+    ranked_vpn_server_list = vpn_server_file.read().splitlines()
+    vpn_server_file.close()
+    other_servers = [server for server in ranked_vpn_server_list if server != exclude]
+    random_vpn_server = random.choice(other_servers or ranked_vpn_server_list)
+    task_info(f"Random new server: {random_vpn_server}")
+    return random_vpn_server
+
+
+def vpn_server_assign(count):
+    """
+    Read the ranked server list file and select count distinct random servers so clients are spread
+    over different servers. Servers are only reused when there are more clients than ranked servers.
+    """
+    with open(state_path(RANKED_SERVER_FILE)) as vpn_server_file:
+        ranked_vpn_server_list = vpn_server_file.read().splitlines()
+    if not ranked_vpn_server_list:
+        return []
+    assigned = []
+    while len(assigned) < count:
+        assigned += random.sample(ranked_vpn_server_list, min(count - len(assigned), len(ranked_vpn_server_list)))
+    return assigned
+
+
+def measure_server(server_id, samples=3, probe_backend="auto", interface=None, score_weights=None,
+                   probe_mode="thread", deadline=10):
+    """
+    Probe a single server samples times and return its latency statistics
+    """
+    vpn_server = ("", server_id)
+    results = []
+    addresses = resolve_servers([vpn_server], 1, deadline)
+    probe_end = time.monotonic() + deadline
+    for sample in range(samples):
+        remaining = probe_end - time.monotonic()
+        if remaining <= 0:
+            break
+        probe_servers([vpn_server], lambda server, result: results.append(result), probe_mode, 1, remaining,
+                      probe_backend, interface, addresses, on_not_probed=lambda server: None)
+    return latency_stats([result for result in results if result is not None], len(results), score_weights)
+
+
+def ranked_details(new_server):
+    """
+    Return the saved ranking details (uplink, proto and port) of a top ranked server
+    """
+    try:
+        with open(state_path(RANKED_DETAILS_FILE)) as details_file:
+            return json.load(details_file).get(new_server) or {}
+    except (OSError, ValueError):
+        return {}
+
+
+def ranked_transport(new_server):
+    """
+    Return the (proto, port) the server was ranked fastest on, or None if transports were not measured
+    """
+    details = ranked_details(new_server)
+    if "proto" not in details:
+        return None
+    task_info(f"Using {details['proto']} port {details['port']} for {new_server}")
+    return details["proto"], details["port"]
+
+
+def ranked_uplink(new_server):
+    """
+    Return the uplink device the server was ranked best over and its address, or (None, None)
+    """
+    uplink = ranked_details(new_server).get("uplink")
+    if not uplink:
+        return None, None
+    try:
+        address = interface_address(uplink)
+    except OSError as e:
+        task_error(e)
+        return uplink, None
+    task_info(f"Using uplink {uplink} ({address}) for {new_server}")
+    return uplink, address
+
+
+def pinned_address(options, new_server):
+    """
+    Return the cached address of the new server if --pin-ip is set, otherwise None
+    """
+    if not options.pin_ip:
+        return None
+    address = resolve_servers([("", new_server.split(".")[0])]).get(new_server.split(".")[0])
+    if address and ":" not in address:
+        task_info(f"Pinning {new_server} to {address}")
+        return address
+    task_error(f"No IPv4 address found for {new_server}. The hostname is used.")
+    return None
+
+
+IPVANISH_HOST_PATTERN = re.compile(r'^[\w\.-]+ipvanish\.com$')
+IPV4_ADDRESS_PATTERN = re.compile(r'^\d+\.\d+\.\d+\.\d+$')
+OPENVPN_DIRECTIVE_PATTERN = re.compile(r'^(\s*)(remote|verify-x509-name|local|lport|proto)(\s+)(\S+)')
+OPENVPN_REMOTE_TRANSPORT_PATTERN = re.compile(r'^(\s+(\d+))?(\s+((udp|tcp)\S*))?', re.IGNORECASE)
+PFSENSE_CLIENT_PATTERN = re.compile(r'<openvpn-client>.*?</openvpn-client>', re.S)
+# Clients updated in parallel share config.xml
+PFSENSE_CONFIG_LOCK = threading.Lock()
+
+
+def write_file_atomic(filename, data):
+    """
+    Write a file through a temporary file in the same directory which is synced to disk and
+    renamed over the file, so a crash mid-write never leaves a partial file. The file mode is kept.
+    """
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except OSError:
+        mode = 0o644
+    directory = os.path.dirname(os.path.abspath(filename))
+    temp_fd, temp_filename = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(temp_fd, "w") as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_filename, mode)
+        os.replace(temp_filename, filename)
+    except OSError:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def openvpn_directives(config_data):
+    """
+    Yield (line number, match) for the remote, verify-x509-name, local, lport and proto directives
+    of an OpenVPN config. Inline files such as <ca> blocks are skipped.
+    """
+    inline_tag = None
+    for line_number, line in enumerate(config_data.splitlines(True)):
+        stripped = line.strip()
+        if inline_tag:
+            if stripped == f"</{inline_tag}>":
+                inline_tag = None
+            continue
+        inline_match = re.match(r'^<([\w-]+)>$', stripped)
+        if inline_match:
+            inline_tag = inline_match.group(1)
+            continue
+        directive_match = OPENVPN_DIRECTIVE_PATTERN.match(line)
+        if directive_match:
+            yield line_number, directive_match
+
+
+def openvpn_config_server(config_data):
+    """
+    Return the IPVanish server of an OpenVPN config from verify-x509-name or remote, or None
+    """
+    servers = {}
+    for line_number, match in openvpn_directives(config_data):
+        if IPVANISH_HOST_PATTERN.match(match.group(4)):
+            servers.setdefault(match.group(2), match.group(4))
+    return servers.get("verify-x509-name") or servers.get("remote")
+
+
+def transport_proto(current, proto):
+    """
+    Return the proto value for a transport keeping the address family and case of the current value,
+    so udp4 becomes tcp4 and TCP becomes UDP. tcp-client is kept for tcp.
+    """
+    match = re.match(r'^(udp|tcp)([46]?)(-client)?$', current, re.IGNORECASE)
+    if not match:
+        return proto
+    value = proto + match.group(2) + ("-client" if proto == "tcp" and match.group(3) else "")
+    return value.upper() if current.isupper() else value
+
+
+def remote_transport(remote_arguments, transport):
+    """
+    Return the arguments after the host of a remote directive with the port and any proto set to the transport
+    """
+    proto, port = transport
+    match = OPENVPN_REMOTE_TRANSPORT_PATTERN.match(remote_arguments)
+    remote_proto = f" {transport_proto(match.group(4), proto)}" if match.group(3) else ""
+    return f" {port}{remote_proto}" + remote_arguments[match.end():]
+
+
+def update_openvpn_directives(config_data, new_server, address=None, local=None, transport=None):
+    """
+    Return the OpenVPN config with the IPVanish remote and verify-x509-name directives set to the new server.
+    The remote is set to the address if one is given. If a local address is given the client is bound to it
+    with a local directive, which replaces nobind, and lport 0 unless an lport is set so clients sharing
+    the local address do not all bind port 1194. With a (proto, port) transport the remote port and the
+    proto are set to it. All other lines are left untouched.
+    """
+    lines = config_data.splitlines(True)
+    remote_line = None
+    local_set = False
+    lport_set = False
+    proto_set = False
+    for line_number, match in openvpn_directives(config_data):
+        directive, value = match.group(2), match.group(4)
+        lport_set = lport_set or directive == "lport"
+        line = lines[line_number]
+        remainder = line[match.end(4):]
+        if directive == "remote" and (IPVANISH_HOST_PATTERN.match(value) or IPV4_ADDRESS_PATTERN.match(value)):
+            value = address or new_server
+            remote_line = line_number if remote_line is None else remote_line
+            if transport:
+                remainder = remote_transport(remainder, transport)
+        elif directive == "verify-x509-name" and IPVANISH_HOST_PATTERN.match(value):
+            value = new_server
+        elif directive == "local" and local:
+            value = local
+            local_set = True
+        elif directive == "proto" and transport:
+            value = transport_proto(value, transport[0])
+            proto_set = True
+        else:
+            continue
+        lines[line_number] = line[:match.start(4)] + value + remainder
+    if transport and not proto_set:
+        lines.insert(len(lines) if remote_line is None else remote_line + 1, f"proto {transport[0]}\n")
+    if local:
+        position = len(lines) if remote_line is None else remote_line + 1
+        if not lport_set:
+            lines.insert(position, "lport 0\n")
+        if not local_set:
+            lines.insert(position, f"local {local}\n")
+        # nobind would make OpenVPN ignore the local address
+        lines = [line for line in lines if line.strip() != "nobind"]
+    return "".join(lines)
+
+
+def pfsense_client_entry(config_data, client_number):
+    """
+    Return the regex match of the <openvpn-client> entry with the vpnid client_number in a pfSense config.xml
+    """
+    vpnid_pattern = re.compile(r'<vpnid>\s*{0}\s*</vpnid>'.format(re.escape(client_number)))
+    for match in PFSENSE_CLIENT_PATTERN.finditer(config_data):
+        if vpnid_pattern.search(match.group()):
+            return match
+    return None
+
+
+def pfsense_interface_name(config_data, device):
+    """
+    Return the pfSense interface name such as wan or opt1 of a network device such as igb1, or None
+    """
+    interfaces = ElementTree.fromstring(config_data).find("interfaces")
+    for interface in interfaces if interfaces is not None else []:
+        if (interface.findtext("if") or "").strip() == device:
+            return interface.tag
+    return None
+
+
+def update_pfsense_client(config_data, client_number, new_server, uplink=None, transport=None):
+    """
+    Return the pfSense config.xml with server_addr and any verify-x509-name custom option of one
+    OpenVPN client set to the new server. With an uplink device the client interface is set to it
+    and with a (proto, port) transport the protocol and server_port.
+    Only the client entry is changed and the result is checked by parsing it so config.xml is never
+    written with a broken client entry.
+    """
+    entry = pfsense_client_entry(config_data, client_number)
+    if not entry:
+        raise ValueError(f"OpenVPN client {client_number} not found")
+    client_data = re.sub(r'(<server_addr>)[^<]*(</server_addr>)',
+                         lambda match: match.group(1) + new_server + match.group(2), entry.group())
+    client_data = re.sub(r'(verify-x509-name\s+)[\w\.-]+ipvanish\.com',
+                         lambda match: match.group(1) + new_server, client_data)
+    interface_name = pfsense_interface_name(config_data, uplink) if uplink else None
+    if uplink and not interface_name:
+        task_error(f"No pfSense interface found for uplink {uplink}. The client interface is not changed.")
+    if interface_name:
+        client_data = re.sub(r'(<interface>)[^<]*(</interface>)',
+                             lambda match: match.group(1) + interface_name + match.group(2), client_data)
+    if transport:
+        client_data = re.sub(r'(<protocol>)([^<]*)(</protocol>)',
+                             lambda match: match.group(1) + transport_proto(match.group(2).strip() or "UDP4",
+                                                                            transport[0]) + match.group(3),
+                             client_data)
+        client_data = re.sub(r'(<server_port>)[^<]*(</server_port>)',
+                             lambda match: match.group(1) + str(transport[1]) + match.group(2), client_data)
+    new_config_data = config_data[:entry.start()] + client_data + config_data[entry.end():]
+    root = ElementTree.fromstring(new_config_data)
+    for client in root.iter("openvpn-client"):
+        if (client.findtext("vpnid") or "").strip() == client_number:
+            if client.findtext("server_addr") == new_server and \
+                    (not interface_name or client.findtext("interface") == interface_name) and \
+                    (not transport or client.findtext("server_port") == str(transport[1])):
+                return new_config_data
+    raise ValueError(f"OpenVPN client {client_number} server_addr was not updated")
+
+
+def current_openvpn_server(filename, client_number=None):
+    """
+    Return the IPVanish server currently set in an OpenVPN or pfSense config file or None
+    """
+    try:
+        with open(filename) as config_file:
+            config_data = config_file.read()
+    except OSError as e:
+        task_error(e)
+        return None
+    if filename.endswith(".xml"):
+        entry = pfsense_client_entry(config_data, client_number or PFSENSE_CLIENT)
+        server = entry and re.search(r'<server_addr>\s*([^<\s]*)', entry.group())
+        return server.group(1) if server else None
+    return openvpn_config_server(config_data)
+
+
+def write_config_file(filename, config_data, new_config_data):
+    """
+    Atomically write a changed config file, a config file without changes is not written
+    """
+    if new_config_data == config_data:
+        task_pass()
+        task_info(f'The new server is the same as the old server. No changes required.')
+        return
+    write_file_atomic(filename, new_config_data)
+    task_pass()
+
+
+def update_openvpn_config(filename, new_server, address=None, local=None, transport=None):
+    """
+    Update the remote and verify-x509-name directives of an OpenVPN configuration file with the new server.
+    If an address is given it is pinned on the remote line so OpenVPN does not resolve the
+    hostname at start. Without an address a previously pinned remote is reset to the hostname.
+    If a local address is given the client is bound to it to use that uplink.
+    If a (proto, port) transport is given the proto and remote port are set to it.
+    """
+    try:
+        with open(filename) as config_file:
+            config_data = config_file.read()
+        old_server = openvpn_config_server(config_data)
+        if not old_server:
+            raise ValueError(f'No remote or verify-x509-name directive for "*ipvanish.com" in {filename}')
+        task_info(f'Found old server: {old_server}')
+        task_start(f'Updating new server in config file: {filename}')
+        write_config_file(filename, config_data,
+                          update_openvpn_directives(config_data, new_server, address, local, transport))
+    except (OSError, ValueError) as e:
+        task_fail()
+        task_error(e)
+
+
+def update_pfsense_config(filename, client_number, new_server, uplink=None, transport=None):
+    """
+    Update the server (and with an uplink device the interface, with a transport the protocol and port)
+    of one OpenVPN client in the pfSense config.xml
+    """
+    try:
+        with PFSENSE_CONFIG_LOCK:
+            with open(filename) as config_file:
+                config_data = config_file.read()
+            task_info(f'Found old server: {current_openvpn_server(filename, client_number)}')
+            task_start(f'Updating new server of OpenVPN client {client_number} in config file: {filename}')
+            write_config_file(filename, config_data,
+                              update_pfsense_client(config_data, client_number, new_server, uplink, transport))
+    except (OSError, ValueError, ElementTree.ParseError) as e:
+        task_fail()
+        task_error(e)
+
+
+def debian_service_manager(service, action):
+    """
+    Start or stop Debian based OS service
+    """
+    print()
+    task_info(f"Running command to {action} {service} service...")
+    run_command(f'systemctl {action} {service}')
+
+
+def pfsense_service_manager(client_number, action):
+    """
+    Restart openvpn on pfsense server
+    """
+    print()
+    task_info(f"Running command to {action} pfsense openvpn service...")
+    run_command(
+        f'/usr/local/sbin/pfSsh.php playback svc {action} openvpn client {client_number}')
+
+
+def debian_service_status(service):
+    """
+    Check if service is active or inactive
+    """
+    print()
+    task_info("Checking OpenVPN service status")
+    status = run_command_shell(f'systemctl is-active {service}')
+    if status:
+        task_info(f'The {service} service status is: {status}')
+    else:
+        task_error(f'Unable to get status of {service} service')
+    return status
+
+
+INTERNET_CHECK_TARGETS = [("1.1.1.1", 53), ("google.com", 80)]
+INTERNET_CHECK_TIMEOUT = 3
+EGRESS_IP_RESOLVER = "208.67.222.222"
+EGRESS_IP_HOSTNAME = "myip.opendns.com"
+IP_INFO_CACHE_FILE = "vpn_ip_info.json"
+IP_INFO_TTL_HOURS = 24
+
+
+def connection_time(host, port, timeout=INTERNET_CHECK_TIMEOUT):
+    """
+    Return the TCP connect time in ms to a host and port. Raises OSError if the connection fails.
+    """
+    start = time.perf_counter()
+    with socket.create_connection((host, port), timeout):
+        return (time.perf_counter() - start) * 1000
+
+
+def egress_ip(timeout=INTERNET_CHECK_TIMEOUT):
+    """
+    Return our public IPv4 address with a DNS query for myip.opendns.com to an OpenDNS resolver,
+    which is not rate limited like ipinfo.io. Raises OSError or ValueError if no address is returned.
+    """
+    query_id = random.randrange(65536)
+    question = b"".join(bytes([len(label)]) + label.encode() for label in EGRESS_IP_HOSTNAME.split(".")) + b"\0"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(struct.pack("!6H", query_id, 0x0100, 1, 0, 0, 0) + question + struct.pack("!2H", 1, 1),
+                    (EGRESS_IP_RESOLVER, 53))
+        response = sock.recv(512)
+    reply_id, flags, question_count, answer_count = struct.unpack("!4H", response[:8])
+    if reply_id != query_id or flags & 0x000f:
+        raise ValueError(f"Invalid reply from {EGRESS_IP_RESOLVER} for {EGRESS_IP_HOSTNAME}")
+    offset = 12 + len(question) + 4
+    for _ in range(answer_count):
+        # Skip the answer name, either a compression pointer or labels
+        while response[offset] and response[offset] < 0xc0:
+            offset += response[offset] + 1
+        offset += 2 if response[offset] else 1
+        record_type, record_class, ttl, length = struct.unpack("!2HIH", response[offset:offset + 10])
+        offset += 10
+        if record_type == 1 and length == 4:
+            return socket.inet_ntoa(response[offset:offset + 4])
+        offset += length
+    raise ValueError(f"No address in reply from {EGRESS_IP_RESOLVER} for {EGRESS_IP_HOSTNAME}")
+
+
+def check_internet():
+    """
+    Determine Internet connectity by connecting to all check targets at the same time while looking up
+    our public IP address. Exit program if check fails.
+    """
+    task_info("Testing Internet connectivity...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(INTERNET_CHECK_TARGETS) + 1) as executor:
+        egress_future = executor.submit(egress_ip)
+        futures = [executor.submit(connection_time, host, port) for host, port in INTERNET_CHECK_TARGETS]
+        connected = True
+        for (host, port), future in zip(INTERNET_CHECK_TARGETS, futures):
+            task_start(f"Testing connection to {host} on port: {port}")
+            try:
+                connect_time = future.result()
+                task_pass()
+                task_info(f"Connected to {host} in {connect_time:.0f}ms")
+            except OSError as e:
+                task_fail()
+                task_error(e)
+                connected = False
+        try:
+            address = egress_future.result()
+        except (OSError, ValueError, IndexError, struct.error):
+            address = None
+    if connected:
+        record_tunnel_up()
+        ip_info = get_ip_info(address)
+        return ip_info
+    else:
+        task_error('You cannot continue without a Internet connection.')
+        sys.exit(1)
+
+
+def fetch_ip_info(address=None):
+    """
+    Return the ipinfo.io details of an IP address, or of our public IP address, without any output
+    """
+    url = f'http://ipinfo.io/{address}/json' if address else 'http://ipinfo.io/json'
+    with urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+def cached_ip_info(address=None):
+    """
+    Return the ipinfo.io details of an IP address from the cache, or look them up and cache them for
+    IP_INFO_TTL_HOURS. Without an address our public IP address is looked up and not served from the cache.
+    """
+    try:
+        with open(state_path(IP_INFO_CACHE_FILE)) as cache_file:
+            ip_info_cache = json.load(cache_file)
+    except (OSError, ValueError):
+        ip_info_cache = {}
+    entry = ip_info_cache.get(address) if address else None
+    if entry and time.time() - entry["fetched"] < IP_INFO_TTL_HOURS * 3600:
+        return entry["ip_info"]
+    ip_info = fetch_ip_info(address)
+    now = time.time()
+    ip_info_cache = {ip: entry for ip, entry in ip_info_cache.items()
+                     if now - entry["fetched"] < IP_INFO_TTL_HOURS * 3600}
+    ip_info_cache[ip_info.get("ip", address)] = {"ip_info": ip_info, "fetched": now}
+    save_json_file(state_path(IP_INFO_CACHE_FILE), ip_info_cache)
+    return ip_info
+
+
+def get_ip_info(address=None):
+    """
+    Get public IP address using ipinfo.io and sockets module to resolve hostname
+    An signup api access code may be required depending on usage. Results are cached per IP address.
+    Will only show VPN IP if the OpenVPN interface is the default route of all traffic
+    Otherwise your normal service provider WAN IP will be displayed.
+    """
+    print()
+    task_start("Fetching IP info from ipinfo.io")
+    try:
+        ip_info = cached_ip_info(address)
+        ip_address = ip_info['ip']
+        ip_city = ip_info['city']
+        ip_country = ip_info['country']
+        task_pass()
+        task_info(
+            f'IP Address: {TermShow.UNDERLINE}{ip_address}{TermShow.RESET} - City: {ip_city} - Country: {ip_country}')
+        return ip_address
+    except Exception as e:
+        task_fail()
+        task_error(e)
+        return e
+
+
+def get_interface_ip(interface):
+    """
+    Get an interface IP address
+    """
+    print()
+    task_start(f"Finding IP address of {interface} using ifconfig")
+    ip_address = run_command_shell(
+        f'ifconfig {interface} | grep \'inet\' | awk \'$1 == "inet" {{ print $2 }}\'').rstrip()
+    if ip_address:
+        task_pass()
+        task_info(f"IP address for {interface} is: {ip_address}")
+        return ip_address
+    else:
+        task_fail()
+        task_error(f"No IP address details found for {interface}")
+
+
+def get_default_interface():
+    """
+    Find the physical interface of the default route, ignoring VPN tun and tap interfaces.
+    OpenVPN redirect-gateway adds 0.0.0.0/1 and 128.0.0.0/1 routes and leaves the default route in place.
+    """
+    try:
+        with open("/proc/net/route") as route_file:
+            routes = [line.split() for line in route_file.read().splitlines()[1:]]
+        default_routes = sorted((int(route[6]), route[0]) for route in routes
+                                if route[1] == "00000000" and route[7] == "00000000")
+        interfaces = [interface for _, interface in default_routes if not interface.startswith(("tun", "tap"))]
+    except (OSError, IndexError, ValueError):
+        # FreeBSD and pfSense have no /proc/net/route
+        output = run_command_shell('route -n get default 2> /dev/null')
+        interfaces = re.findall(r'interface: (\S+)', output)
+        interfaces = [interface for interface in interfaces if not interface.startswith(("tun", "tap", "ovpn"))]
+    if interfaces:
+        return interfaces[0]
+    return None
+
+
+def check_config_exists(filename):
+    print()
+    task_start(f'Checking for config file: {filename}')
+    if not os.path.isfile(filename):
+        task_fail()
+        task_error(f'\nConfig file {filename} does not exist.\n')
+        sys.exit(1)
+    else:
+        task_pass()
+
+
+READY_POLL_INTERVAL = 0.2
+SIOCGIFADDR = 0x8915
+
+
+def tunnel_interface_up(interface):
+    """
+    Check if a tunnel interface exists, is up and has an IPv4 address. OpenVPN assigns the
+    address just before the connection is complete.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            with open(f"/sys/class/net/{interface}/flags") as flags_file:
+                flags = int(flags_file.read(), 16)
+        except (OSError, ValueError):
+            return False
+        if not flags & 0x1:
+            return False
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', interface[:15].encode()))
+            except OSError:
+                return False
+        return True
+    output = run_command_shell(f'ifconfig {shlex.quote(interface)} 2> /dev/null')
+    return bool(re.search(r'<UP[,>]', output)) and "inet " in output
+
+
+def management_connect(address, timeout=3):
+    """
+    Connect to an OpenVPN management interface given as host:port or a unix socket path
+    """
+    if "/" in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        target = address
+    else:
+        host, _, port = address.rpartition(":")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target = (host or "127.0.0.1", int(port))
+    sock.settimeout(timeout)
+    try:
+        sock.connect(target)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class OpenVPNManagement:
+    """
+    Client for the OpenVPN management interface. Command replies are returned and real time
+    notifications (lines starting with >) received in between are kept in notifications.
+    """
+
+    def __init__(self, address, timeout=3):
+        self.address = address
+        self.timeout = timeout
+        self.sock = management_connect(address, timeout)
+        self.reader = self.sock.makefile("r", encoding="utf-8", errors="replace")
+        self.notifications = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def read_line(self, timeout=None):
+        """
+        Read one line from the management interface
+        """
+        self.sock.settimeout(max(0.01, timeout if timeout is not None else self.timeout))
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError(f"Management interface {self.address} closed the connection")
+        return line.rstrip("\r\n")
+
+    def command(self, command):
+        """
+        Send a command and return the SUCCESS message or the lines of a multi-line reply
+        """
+        self.sock.sendall(command.encode() + b"\n")
+        lines = []
+        while True:
+            line = self.read_line()
+            if line.startswith(">"):
+                self.notifications.append(line)
+            elif line.startswith("SUCCESS:"):
+                return line[8:].strip()
+            elif line.startswith("ERROR:"):
+                raise RuntimeError(f"Management command {command} failed. {line[6:].strip()}")
+            elif line == "END":
+                return lines
+            else:
+                lines.append(line)
+
+    def wait_for_notification(self, prefix, timeout):
+        """
+        Return the next real time notification starting with prefix such as >STATE: or None on timeout
+        """
+        end_time = time.monotonic() + timeout
+        while True:
+            for line in self.notifications:
+                if line.startswith(prefix):
+                    self.notifications.remove(line)
+                    return line
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                self.notifications.append(self.read_line(remaining))
+            except socket.timeout:
+                return None
+
+    def state(self):
+        """
+        Return the current connection state such as CONNECTED with local and remote addresses
+        """
+        fields = self.command("state")[-1].split(",")
+        fields += [""] * (5 - len(fields))
+        return {"time": fields[0], "state": fields[1], "description": fields[2],
+                "local_ip": fields[3], "remote_ip": fields[4]}
+
+    def byte_count(self):
+        """
+        Return the tunnel (bytes in, bytes out) counters
+        """
+        stats = dict(item.split("=", 1) for item in self.command("load-stats").split(",") if "=" in item)
+        return int(stats.get("bytesin", 0)), int(stats.get("bytesout", 0))
+
+    def signal(self, signal_name):
+        """
+        Send a signal such as SIGHUP (reload config and reconnect) or SIGUSR1 (reconnect)
+        """
+        return self.command(f"signal {signal_name}")
+
+    def remote(self, action, host=None, port=None):
+        """
+        Answer a >REMOTE: query with ACCEPT, SKIP or MOD host port. Requires management-query-remote.
+        """
+        return self.command(" ".join(str(item) for item in ("remote", action, host, port) if item is not None))
+
+    def wait_for_state(self, state, timeout):
+        """
+        Wait for a >STATE: notification reporting state. Returns True if it arrived before the timeout.
+        """
+        end_time = time.monotonic() + timeout
+        while time.monotonic() < end_time:
+            line = self.wait_for_notification(">STATE:", end_time - time.monotonic())
+            if line and line.split(",")[1:2] == [state]:
+                return True
+        return False
+
+
+def wait_for_management_state(address, state, end_time):
+    """
+    Wait for the OpenVPN management interface to report a state such as CONNECTED.
+    Real time state notifications are enabled so the wait ends as soon as the state changes.
+    """
+    while time.monotonic() < end_time:
+        try:
+            with OpenVPNManagement(address) as client:
+                client.command("state on")
+                if client.state()["state"] == state:
+                    return True
+                return client.wait_for_state(state, end_time - time.monotonic())
+        except (OSError, RuntimeError):
+            # The management interface is not listening until OpenVPN has started
+            time.sleep(READY_POLL_INTERVAL)
+    return False
+
+
+def management_reconnect(address, host=None, port=None, query_remote=False, timeout=30):
+    """
+    Reconnect OpenVPN to a new server through the management interface without restarting the service.
+    With management-query-remote the new server is given as the answer to the >REMOTE: query after a
+    SIGUSR1 reconnect, otherwise a SIGHUP makes OpenVPN re-read the updated config file.
+    Without a port the port of the >REMOTE: query is kept. Returns True once the tunnel reports CONNECTED again.
+    """
+    task_start(f"Reconnecting OpenVPN through management interface {address}")
+    start = time.monotonic()
+    try:
+        with OpenVPNManagement(address) as client:
+            client.command("state on")
+            if query_remote and host:
+                client.signal("SIGUSR1")
+                query = client.wait_for_notification(">REMOTE:", timeout)
+                if not query:
+                    raise RuntimeError("No >REMOTE: query received. Is management-query-remote set?")
+                # The query looks like >REMOTE:host,port,proto
+                client.remote("MOD", host, port or query[8:].split(",")[1])
+            else:
+                client.signal("SIGHUP")
+            connected = client.wait_for_state("CONNECTED", timeout)
+    except (OSError, RuntimeError) as e:
+        task_fail()
+        task_error(e)
+        return False
+    if not connected:
+        task_fail()
+        task_error(f"The VPN tunnel did not connect within {timeout} seconds")
+        return False
+    task_pass()
+    task_info(f"VPN tunnel reconnected after {time.monotonic() - start:.1f} seconds")
+    return True
+
+
+def openvpn_config_has(filename, directive):
+    """
+    Check if an OpenVPN config file contains a directive
+    """
+    try:
+        with open(filename) as config_file:
+            return any(line.split()[:1] == [directive] for line in config_file)
+    except OSError:
+        return False
+
+
+def pfsense_client_paths(client_number):
+    """
+    Return the generated OpenVPN config file and management socket of a pfSense client.
+    pfSense 2.5 and later use a directory per client, earlier versions use flat files.
+    """
+    client_dir = f"/var/etc/openvpn/client{client_number}"
+    if os.path.isdir(client_dir):
+        return os.path.join(client_dir, "config.ovpn"), os.path.join(client_dir, "sock")
+    return client_dir + ".conf", client_dir + ".sock"
+
+
+def wait_for_tunnel(interface, timeout=30, management=None):
+    """
+    Wait until the VPN tunnel is connected or the timeout in seconds is reached.
+    Uses the OpenVPN management interface when available, otherwise watches the tunnel interface.
+    """
+    task_start(f"Waiting up to {timeout} seconds for the VPN tunnel to connect")
+    start = time.monotonic()
+    end_time = start + timeout
+    if management:
+        ready = wait_for_management_state(management, "CONNECTED", end_time)
+    else:
+        ready = False
+        while not ready and time.monotonic() < end_time:
+            ready = tunnel_interface_up(interface)
+            if not ready:
+                time.sleep(READY_POLL_INTERVAL)
+    if not ready:
+        task_fail()
+        task_error(f"The VPN tunnel did not connect within {timeout} seconds")
+        return False
+    task_pass()
+    task_info(f"VPN tunnel connected after {time.monotonic() - start:.1f} seconds")
+    return True
+
+
+def wait_for_tunnel_down(service, interface, timeout=30):
+    """
+    Wait until the service is no longer active and the tunnel interface has gone down
+    """
+    task_start(f"Waiting up to {timeout} seconds for {service} to stop")
+    start = time.monotonic()
+    end_time = start + timeout
+    while time.monotonic() < end_time:
+        if run_command_shell(f'systemctl is-active {service}') != "active" and \
+                not tunnel_interface_up(interface):
+            task_pass()
+            task_info(f"The {service} service stopped after {time.monotonic() - start:.1f} seconds")
+            return True
+        time.sleep(READY_POLL_INTERVAL)
+    task_fail()
+    task_error(f"The {service} service did not stop within {timeout} seconds")
+    return False
+
+
+DEBIAN_CONFIG_FILE = "/etc/openvpn/client.conf"
+PFSENSE_CONFIG_FILE = "/cf/conf/config.xml"
+# Number of the pfSense client will need to be changed depending on config file name
+# in /var/etc/openvpn/clientx.conf or /var/etc/openvpn/clientx/config.ovpn
+PFSENSE_CLIENT = "2"
+
+
+def openvpn_config_value(filename, directive):
+    """
+    Return the arguments of the first directive in an OpenVPN config file or None
+    """
+    try:
+        with open(filename) as config_file:
+            for line in config_file:
+                words = line.split()
+                if words[:1] == [directive]:
+                    return words[1:]
+    except OSError:
+        pass
+    return None
+
+
+def transport_changes_proto(filename, transport):
+    """
+    Return True if the transport changes the proto of an OpenVPN config file. The management
+    interface can only change the remote host and port so a new proto needs the config re-read.
+    """
+    if not transport:
+        return False
+    proto = (openvpn_config_value(filename, "proto") or ["udp"])[0]
+    return not proto.lower().startswith(transport[0])
+
+
+def management_remote_usable(filename, new_server, transport=None):
+    """
+    Return True if the new server can be given to the running OpenVPN as the answer to a >REMOTE: query.
+    SIGUSR1 does not re-read the config file so this needs management-query-remote and a
+    verify-x509-name and proto that do not change. Called before the config file is updated.
+    """
+    if not openvpn_config_has(filename, "management-query-remote"):
+        return False
+    verify_name = openvpn_config_value(filename, "verify-x509-name")
+    if verify_name and verify_name[0] != new_server:
+        return False
+    return not transport_changes_proto(filename, transport)
+
+
+def debian_client(options, client=None):
+    """
+    Return the config file, service, tunnel interface and management interface of a Debian OpenVPN client.
+    Without a client the default client.conf with the openvpn service and the command line options is used.
+    Other clients use the openvpn@<name> service and the dev and management directives of their config.
+    """
+    if not client:
+        return DEBIAN_CONFIG_FILE, "openvpn", options.tun_interface or "tun0", options.management
+    config_file = client if "/" in client else os.path.join("/etc/openvpn", client)
+    if not config_file.endswith(".conf"):
+        config_file += ".conf"
+    name = os.path.basename(config_file)[:-len(".conf")]
+    dev = openvpn_config_value(config_file, "dev")
+    # Only a numbered device such as tun1 can be watched, dev tun picks the next free device
+    tun_interface = dev[0] if dev and re.search(r'\d$', dev[0]) else None
+    management = openvpn_config_value(config_file, "management")
+    if management and len(management) > 1 and management[1] == "unix":
+        management = management[0]
+    elif management and len(management) > 1:
+        management = f"{management[0]}:{management[1]}"
+    else:
+        management = None
+    return config_file, f"openvpn@{name}", tun_interface, management
+
+
+def apply_new_server(server_os, options, new_server, client=None):
+    """
+    Write the new server to the OpenVPN config and reconnect the tunnel, through the management
+    interface when available or with a single restart otherwise. Used while the tunnel is up.
+    The client is a Debian client config or pfSense client id, the default client if not given.
+    """
+    ready_timeout = options.ready_timeout
+    address = pinned_address(options, new_server)
+    uplink, local = ranked_uplink(new_server)
+    transport = ranked_transport(new_server)
+    port = transport[1] if transport else None
+    record_tunnel_down()
+    if server_os == "debian":
+        config_file, service, tun_interface, management = debian_client(options, client)
+        query_remote = management_remote_usable(config_file, new_server, transport)
+        update_openvpn_config(config_file, new_server, address, local, transport)
+        if not management or not management_reconnect(management, address or new_server, port, query_remote,
+                                                      ready_timeout):
+            debian_service_manager(service, "restart")
+            if tun_interface or management:
+                wait_for_tunnel(tun_interface, ready_timeout, management)
+            else:
+                task_info(f"No numbered dev or management interface in {config_file} to wait for the tunnel")
+    elif server_os == "pfsense":
+        client_number = client or PFSENSE_CLIENT
+        update_pfsense_config(PFSENSE_CONFIG_FILE, client_number, new_server, uplink, transport)
+        pfsense_tun_interface = (not client and options.tun_interface) or f"ovpnc{client_number}"
+        client_config_file, client_management = pfsense_client_paths(client_number)
+        management = (not client and options.management) or client_management
+        # The running client uses the generated config, update it and reload in place
+        # instead of restarting the service so the old server is not cached
+        if os.path.isfile(client_config_file) and (options.management or os.path.exists(management)):
+            query_remote = management_remote_usable(client_config_file, new_server, transport)
+            update_openvpn_config(client_config_file, new_server, address, local, transport)
+            reconnected = management_reconnect(management, address or new_server, port, query_remote,
+                                               ready_timeout)
+        else:
+            reconnected = False
+        if not reconnected:
+            # Wait on the management interface of this client, not the one of the default client
+            if not (not client and options.management) and not os.path.exists(client_management):
+                management = None
+            # Workaround until issue with old server caching can be fixed.
+            pfsense_service_manager(client_number, "restart")
+            wait_for_tunnel(pfsense_tun_interface, ready_timeout, management)
+            pfsense_service_manager(client_number, "restart")
+            wait_for_tunnel(pfsense_tun_interface, ready_timeout, management)
+            pfsense_service_manager(client_number, "restart")
+            wait_for_tunnel(pfsense_tun_interface, ready_timeout, management)
+
+
+def apply_new_servers(server_os, options, clients, servers_ranked=None):
+    """
+    Assign distinct ranked servers to several clients and update and reconnect them concurrently
+    """
+    new_servers = vpn_server_assign(len(clients))
+    if not new_servers:
+        task_error("No ranked servers to assign to the clients")
+        return {}
+    assignments = dict(zip(clients, new_servers))
+    for client, new_server in assignments.items():
+        task_info(f"Client {client} new server: {new_server}")
+    record_chosen_server(servers_ranked, new_servers[0])
+    RUN_RECORD["clients"] = assignments
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        futures = {executor.submit(apply_new_server, server_os, options, new_server, client): client
+                   for client, new_server in assignments.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                task_error(f"Unable to apply new server to client {futures[future]}. {e}")
+    return assignments
+
+
+def tunnel_byte_counters(interface, management=None):
+    """
+    Return the (bytes received, bytes sent) counters of the tunnel or None if unavailable.
+    Linux counters are read from sysfs, otherwise the management interface is used.
+    """
+    try:
+        counters = []
+        for name in ("rx_bytes", "tx_bytes"):
+            with open(f"/sys/class/net/{interface}/statistics/{name}") as counter_file:
+                counters.append(int(counter_file.read()))
+        return tuple(counters)
+    except (OSError, ValueError):
+        pass
+    if management:
+        try:
+            with OpenVPNManagement(management) as client:
+                return client.byte_count()
+        except (OSError, RuntimeError):
+            pass
+    return None
+
+
+def next_ranked_server(current_server):
+    """
+    Return the server ranked after the current server in the ranked server list file,
+    or the top ranked server if the current server is not in the list.
+    """
+    try:
+        with open(state_path(RANKED_SERVER_FILE)) as vpn_server_file:
+            ranked_vpn_server_list = vpn_server_file.read().splitlines()
+    except OSError as e:
+        task_error(e)
+        return None
+    if current_server in ranked_vpn_server_list:
+        position = ranked_vpn_server_list.index(current_server)
+        ranked_vpn_server_list = ranked_vpn_server_list[position + 1:] + ranked_vpn_server_list[:position]
+    return ranked_vpn_server_list[0] if ranked_vpn_server_list else None
+
+
+def run_safely(action, description):
+    """
+    Run one step of a long running mode and log any error instead of letting it stop the daemon.
+    Helpers written for single runs exit on failure so SystemExit is caught as well.
+    Returns True if the step completed.
+    """
+    try:
+        action()
+        return True
+    except (Exception, SystemExit) as e:
+        task_error(f"{description} failed. {type(e).__name__}: {e}")
+        return False
+
+
+def fail_over(server_os, options, state, attempts):
+    """
+    Move to the next server of the ranked list until the Internet connectivity check passes,
+    trying at most attempts servers. Returns True once a server passes the check.
+    """
+    for attempt in range(attempts):
+        new_server = next_ranked_server(state["current"])
+        if not new_server or new_server == state["current"]:
+            task_error("No other ranked server available for failover")
+            return False
+        task_info(f"Failing over from {state['current']} to next ranked server {new_server}")
+        apply_new_server(server_os, options, new_server)
+        state["current"] = new_server
+        state["since"] = time.monotonic()
+        if run_safely(check_internet, "Internet connectivity check"):
+            return True
+    return False
+
+
+def schedule_monitor(scheduler, state, server_os, options):
+    """
+    Check the health of the active tunnel every monitor interval by probing the monitor target
+    through the tunnel interface and reading the tunnel byte counters. After monitor failures
+    degraded checks in a row the next server of the ranked list is used without re-ranking.
+    """
+    tun_interface = options.tun_interface or ("tun0" if server_os == "debian" else f"ovpnc{PFSENSE_CLIENT}")
+    probe = PROBE_BACKENDS[select_probe_backend(options.probe_backend)][0]
+    monitor = {"degraded": 0, "counters": tunnel_byte_counters(tun_interface, options.management),
+               "checked": time.monotonic()}
+
+    def check():
+        if not run_safely(health_check, "Tunnel health check"):
+            monitor["degraded"] = 0
+        scheduler.enter(options.monitor_interval, 2, check)
+
+    def health_check():
+        results = []
+        for sample in range(options.samples):
+            try:
+                results.append(probe(options.monitor_target, interface=tun_interface))
+            except OSError:
+                results.append(None)
+        stats = latency_stats([result for result in results if result is not None], len(results),
+                              options.score_weights)
+        now = time.monotonic()
+        counters = tunnel_byte_counters(tun_interface, options.management)
+        throughput = ""
+        if counters and monitor["counters"]:
+            elapsed = max(0.001, now - monitor["checked"])
+            rx_rate, tx_rate = ((new - old) * 8 / elapsed / 1000 for new, old in zip(counters, monitor["counters"]))
+            throughput = f" - throughput in {rx_rate:.0f}kbit/s out {tx_rate:.0f}kbit/s"
+        monitor["counters"] = counters
+        monitor["checked"] = now
+        median = f'{stats["median"]:.0f}ms' if stats["samples"] else "-"
+        task_info(f"Tunnel health {get_date()}: {options.monitor_target} ping {median} loss {stats['loss']:.0%} "
+                  f"score {stats['score']:.0f}{throughput}")
+        if stats["score"] > options.monitor_score:
+            monitor["degraded"] += 1
+            task_error(f"Tunnel degraded ({monitor['degraded']} of {options.monitor_failures} checks)")
+        else:
+            monitor["degraded"] = 0
+        if monitor["degraded"] >= options.monitor_failures:
+            new_server = next_ranked_server(state["current"])
+            if new_server and new_server != state["current"]:
+                task_info(f"Failing over from {state['current']} to next ranked server {new_server}")
+                apply_new_server(server_os, options, new_server)
+                state["current"] = new_server
+                state["since"] = time.monotonic()
+            else:
+                task_error("No other ranked server available for failover")
+            monitor["degraded"] = 0
+            monitor["counters"] = tunnel_byte_counters(tun_interface, options.management)
+            monitor["checked"] = time.monotonic()
+
+    scheduler.enter(options.monitor_interval, 2, check)
+
+
+def run_monitor(server_os, options):
+    """
+    Only monitor the active tunnel and fail over to the next ranked server when it degrades
+    """
+    config_file = DEBIAN_CONFIG_FILE if server_os == "debian" else PFSENSE_CONFIG_FILE
+    scheduler = sched.scheduler(time.monotonic, time.sleep)
+    state = {"current": current_openvpn_server(config_file), "since": time.monotonic()}
+    task_info(f"Monitoring tunnel to {state['current']} every {options.monitor_interval} seconds")
+    schedule_monitor(scheduler, state, server_os, options)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print()
+        task_info("Monitor stopped")
+
+
+def run_daemon(server_os, options, rank_settings):
+    """
+    Keep running and re-rank servers every probe interval with the tunnel up. The current server is
+    measured each cycle and only replaced when its score is worse than the rotate score or it has been
+    in use longer than the max age.
+    """
+    config_file = DEBIAN_CONFIG_FILE if server_os == "debian" else PFSENSE_CONFIG_FILE
+    scheduler = sched.scheduler(time.monotonic, time.sleep)
+    state = {"current": current_openvpn_server(config_file), "since": time.monotonic(), "ranked": []}
+    task_info(f"Daemon started. Probing every {options.probe_interval} minutes, rotating when the score is "
+              f"above {options.rotate_score} or after {options.max_age} hours")
+    if options.monitor_interval > 0:
+        schedule_monitor(scheduler, state, server_os, options)
+
+    def cycle():
+        block_heading(f"OVPNMANAGER DAEMON CYCLE {get_date()}")
+        start_run_record("daemon")
+        # A failed cycle is logged and retried at the next probe interval
+        if run_safely(rank_and_rotate, "Daemon cycle"):
+            RUN_RECORD["result"] = "ok"
+        run_safely(lambda: write_run_record(options), "Writing the run record")
+        scheduler.enter(options.probe_interval * 60, 1, cycle)
+
+    def rank_and_rotate():
+        with timed_phase("rank"):
+            state["ranked"] = vpn_server_rank(options.servers, options.filter, **rank_settings)
+        reason = None
+        if not state["current"]:
+            reason = "no current server found in config"
+        else:
+            server_id = state["current"].split(".")[0]
+            stats = measure_server(server_id, rank_settings["samples"], rank_settings["probe_backend"],
+                                   rank_settings["interface"], rank_settings["score_weights"],
+                                   rank_settings["probe_mode"], rank_settings["deadline"])
+            rating, _ = rate_ping(stats["score"])
+            task_info(f"Current server {state['current']} score {stats['score']:.0f} ({rating})")
+            age = (time.monotonic() - state["since"]) / 3600
+            if stats["score"] > options.rotate_score:
+                reason = f"score {stats['score']:.0f} is above {options.rotate_score}"
+            elif age >= options.max_age:
+                reason = f"server has been in use for {age:.1f} hours"
+        if reason:
+            task_info(f"Rotating server because {reason}")
+            new_server = vpn_server_random(exclude=state["current"])
+            record_chosen_server(state["ranked"], new_server)
+            with timed_phase("apply"):
+                apply_new_server(server_os, options, new_server)
+            state["current"] = new_server
+            state["since"] = time.monotonic()
+            with timed_phase("verify"):
+                verified = run_safely(check_internet, "Internet connectivity check") or \
+                    fail_over(server_os, options, state, rank_settings.get("top_servers", 5) - 1)
+            if not verified:
+                raise RuntimeError("No ranked server passed the Internet connectivity check")
+        else:
+            task_info("Current server is within limits. No rotation required.")
+
+    scheduler.enter(0, 1, cycle)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print()
+        task_info("Daemon stopped")
+
+
+RUN_RECORD_FILE = "ovpnmanager_last_run.json"
+RUN_RECORD = {}
+
+
+def start_run_record(mode):
+    """
+    Start a new run record. Phases, probes, downtime and the chosen server are added during the run.
+    """
+    RUN_RECORD.clear()
+    RUN_RECORD.update({"mode": mode, "started": time.time(), "result": "failed", "phases": {}, "probes": [],
+                       "downtime": None, "server": None})
+
+
+@contextlib.contextmanager
+def timed_phase(name):
+    """
+    Add the duration in seconds of the with block to the phase in the run record
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phases = RUN_RECORD.setdefault("phases", {})
+        phases[name] = round(phases.get(name, 0) + time.monotonic() - start, 3)
+
+
+def record_tunnel_down():
+    """
+    Mark the start of tunnel downtime, it ends at the next passing check_internet()
+    """
+    RUN_RECORD["down_since"] = time.monotonic()
+
+
+def record_tunnel_up():
+    """
+    End the tunnel downtime started by record_tunnel_down()
+    """
+    down_since = RUN_RECORD.pop("down_since", None)
+    if down_since is not None:
+        RUN_RECORD["downtime"] = round(time.monotonic() - down_since, 3)
+
+
+def record_chosen_server(servers_ranked, new_server):
+    """
+    Add the chosen server and its ranking stats to the run record
+    """
+    RUN_RECORD["server"] = {"host": new_server}
+    for server in servers_ranked or []:
+        if vpn_server_hostname(server[1]) == new_server:
+            RUN_RECORD["server"].update(location=server[0], rating=server[3],
+                                        stats={key: value for key, value in server[4].items()
+                                               if isinstance(value, (int, float))})
+
+
+def prometheus_metrics(run_record):
+    """
+    Return the run record in the Prometheus text exposition format
+    """
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP ovpnmanager_{name} {help_text}")
+        lines.append(f"# TYPE ovpnmanager_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"ovpnmanager_{name}{{{label_text}}} {value}" if label_text else f"ovpnmanager_{name} {value}")
+
+    mode = {"mode": run_record["mode"]}
+    metric("run_timestamp_seconds", "Start time of the last run", [(mode, run_record["started"])])
+    metric("run_duration_seconds", "Duration of the last run", [(mode, run_record["duration"])])
+    metric("run_success", "1 if the last run finished", [(mode, int(run_record["result"] == "ok"))])
+    metric("phase_duration_seconds", "Duration of each phase of the last run",
+           [(dict(mode, phase=phase), duration) for phase, duration in sorted(run_record["phases"].items())])
+    if run_record["downtime"] is not None:
+        metric("tunnel_downtime_seconds", "Time without a working tunnel in the last run",
+               [(mode, run_record["downtime"])])
+    probes = run_record["probes"]
+    metric("probes", "Probes sent in the last run", [(mode, len(probes))])
+    metric("probes_lost", "Probes without a response in the last run",
+           [(mode, sum(1 for probe in probes if probe[1] is None))])
+    server = run_record["server"]
+    if server and server.get("stats"):
+        labels = dict(mode, server=server["host"])
+        for stat in ("median", "jitter", "loss", "score"):
+            if stat in server["stats"]:
+                metric(f"server_{stat}", f"Ranking {stat} of the chosen server", [(labels, server["stats"][stat])])
+    return "\n".join(lines) + "\n"
+
+
+def write_run_record(options):
+    """
+    Write the run record as JSON and, if a Prometheus textfile is set, in the Prometheus text format
+    """
+    RUN_RECORD.pop("down_since", None)
+    RUN_RECORD["duration"] = round(time.time() - RUN_RECORD["started"], 3)
+    if options.run_record:
+        save_json_file(state_path(options.run_record), RUN_RECORD)
+    if options.prometheus_file:
+        try:
+            write_file_atomic(options.prometheus_file, prometheus_metrics(RUN_RECORD))
+        except OSError as e:
+            task_error(f"Unable to write {options.prometheus_file}. {e}")
+
+
+def read_status(config_file=None, run_record_file=RUN_RECORD_FILE):
+    """
+    Return the current server, last ranking and last probe stats from the config, ranked server list,
+    run record and probe history. Only local files are read, no network or service access.
+    """
+    if not config_file:
+        try:
+            with open("/etc/platform") as platform_file:
+                pfsense = "pfsense" in platform_file.read().lower()
+        except OSError:
+            pfsense = False
+        config_file = PFSENSE_CONFIG_FILE if pfsense else DEBIAN_CONFIG_FILE
+    status = {"config": config_file, "server": None, "remote": None, "ranked": [], "ranked_at": None,
+              "last_run": None, "probes": None}
+    if os.path.isfile(config_file):
+        status["server"] = current_openvpn_server(config_file)
+        remote = openvpn_config_value(config_file, "remote")
+        status["remote"] = remote[0] if remote else None
+    try:
+        status["ranked"] = open(state_path(RANKED_SERVER_FILE)).read().splitlines()
+        status["ranked_at"] = os.path.getmtime(state_path(RANKED_SERVER_FILE))
+    except OSError:
+        pass
+    try:
+        with open(state_path(run_record_file)) as run_record:
+            last_run = json.load(run_record)
+        last_run.pop("probes", None)
+        status["last_run"] = last_run
+    except (OSError, ValueError):
+        pass
+    if status["server"] and os.path.isfile(state_path(HISTORY_DB_FILE)):
+        try:
+            connection = sqlite3.connect(f"file:{state_path(HISTORY_DB_FILE)}?mode=ro", uri=True)
+            rows = connection.execute("SELECT probed, rtt FROM probes WHERE server_id = ? ORDER BY probed DESC "
+                                      "LIMIT 10", (status["server"].split(".")[0],)).fetchall()
+            connection.close()
+        except sqlite3.Error:
+            rows = []
+        if rows:
+            stats = latency_stats([rtt for probed, rtt in rows if rtt is not None], len(rows))
+            stats["probed"] = rows[0][0]
+            status["probes"] = stats
+    return status
+
+
+def show_status(options):
+    """
+    Show the saved status, as JSON with the json option
+    """
+    status = read_status(options.config, options.run_record)
+    if options.json:
+        print(json.dumps(status, indent=2))
+        return
+    task_info(f"Current server: {status['server'] or 'unknown'} ({status['config']})")
+    if status["remote"] and status["remote"] != status["server"]:
+        task_info(f"Pinned remote address: {status['remote']}")
+    probes = status["probes"]
+    if probes:
+        rating, _ = rate_ping(probes["score"])
+        median = f"{probes['median']:.0f}ms" if probes["samples"] else "-"
+        task_info(f"Last probes of current server {time.strftime('%Y-%m-%d %H:%M', time.localtime(probes['probed']))}: "
+                  f"median {median} loss {probes['loss']:.0%} score {probes['score']:.0f} ({rating})")
+    if status["ranked"]:
+        ranked_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(status["ranked_at"]))
+        task_info(f"Ranked servers {ranked_at}: {', '.join(status['ranked'])}")
+    last_run = status["last_run"]
+    if last_run:
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(last_run["started"]))
+        downtime = f", downtime {last_run['downtime']:.1f}s" if last_run.get("downtime") is not None else ""
+        task_info(f"Last run {started} {last_run['mode']} {last_run['result']} in {last_run.get('duration', 0):.1f}s"
+                  f"{downtime}")
+
+
+def show_catalog(options):
+    """
+    Show the countries, cities and number of servers of the server catalog matching the filter
+    """
+    catalog = fetch_catalog(options.catalog_ttl)
+    try:
+        server_ids = set(filter_catalog(catalog, options.filter))
+    except ValueError as e:
+        task_error(e)
+        return
+    column_widths = [8, 20, 6, 8]
+    table_decorator(column_widths, "+", "-")
+    table_row_data(column_widths, ["COUNTRY", "CITY", "CODE", "SERVERS"])
+    table_decorator(column_widths, "+", "=")
+    for country, cities in sorted(catalog["index"].items()):
+        for city_code, city_servers in sorted(cities.items()):
+            count = sum(1 for server_id in city_servers if server_id in server_ids)
+            if count:
+                city = catalog["servers"][city_servers[0]]["city"]
+                table_row_data(column_widths, [country.upper(), city, city_code, str(count)])
+    table_decorator(column_widths, "+", "-")
+    fetched = time.strftime('%Y-%m-%d %H:%M', time.localtime(catalog["fetched"]))
+    task_info(f"{len(server_ids)} servers in catalog fetched {fetched}")
+
+
+def show_probe(options):
+    """
+    Probe a single server with the ranking options and show its latency statistics
+    """
+    server_id = options.server.lower().split(".")[0]
+    host = vpn_server_hostname(server_id)
+    task_info(f"Probing {host} {options.samples} times using the {select_probe_backend(options.probe_backend)} "
+              f"probe backend")
+    stats = measure_server(server_id, options.samples, options.probe_backend, options.interface,
+                           options.score_weights, options.probe_mode, options.deadline)
+    rating, result_color = rate_ping(stats["score"])
+    if stats["samples"]:
+        task_info(f"min {stats['min']:.1f}ms median {stats['median']:.1f}ms p90 {stats['p90']:.1f}ms "
+                  f"jitter {stats['jitter']:.1f}ms")
+    task_info(f"loss {stats['loss']:.0%} score {stats['score']:.0f} {result_color}{rating}{TermShow.RESET}")
+
+
+def rotate(options):
+    """
+    Rank servers and rotate the OpenVPN client, the default command
+    """
+    start_run_record("monitor" if options.monitor else "daemon" if options.daemon else
+                     "clients" if options.clients else options.rotation)
+    try:
+        with timed_phase("setup"):
+            check_user()
+            server_os = check_os()
+        server_count = options.servers
+        server_filter = options.filter
+        rank_settings = get_rank_settings(options)
+        ready_timeout = options.ready_timeout
+        management = options.management
+        if (options.rotation == "live" or options.daemon or options.clients) and not options.interface:
+            rank_settings["interface"] = get_default_interface()
+            if not rank_settings["interface"]:
+                task_error("Unable to find the default route interface. Probes will follow the tunnel routes.")
+        if options.monitor and server_os:
+            run_monitor(server_os, options)
+        elif options.daemon and server_os:
+            check_config_exists(DEBIAN_CONFIG_FILE if server_os == "debian" else PFSENSE_CONFIG_FILE)
+            check_internet()
+            run_daemon(server_os, options, rank_settings)
+        elif options.clients and server_os:
+            # Rank once with the tunnels up then rotate every client to a different server
+            with timed_phase("check_internet"):
+                check_internet()
+            with timed_phase("rank"):
+                servers_ranked = vpn_server_rank(server_count, server_filter, **rank_settings)
+            with timed_phase("apply"):
+                apply_new_servers(server_os, options, options.clients, servers_ranked)
+            with timed_phase("verify"):
+                check_internet()
+        elif server_os == "debian" and options.rotation == "live":
+            # Rank and select the new server while the current tunnel is still up then restart once
+            check_config_exists(DEBIAN_CONFIG_FILE)
+            with timed_phase("check_internet"):
+                check_internet()
+            with timed_phase("rank"):
+                servers_ranked = vpn_server_rank(server_count, server_filter, **rank_settings)
+            new_server = vpn_server_random()
+            record_chosen_server(servers_ranked, new_server)
+            with timed_phase("apply"):
+                apply_new_server(server_os, options, new_server)
+            with timed_phase("verify"):
+                check_internet()
+        elif server_os == "debian":
+            # Config filename may need to be changed depending on setup
+            #ovpn_config_file = "testconfig.conf"
+            ovpn_config_file = DEBIAN_CONFIG_FILE
+            check_config_exists(ovpn_config_file)
+            with timed_phase("check_internet"):
+                check_internet()
+            record_tunnel_down()
+            with timed_phase("stop"):
+                debian_service_manager("openvpn", "stop")
+                wait_for_tunnel_down("openvpn", options.tun_interface or "tun0", ready_timeout)
+            with timed_phase("rank"):
+                servers_ranked = vpn_server_rank(server_count, server_filter, **rank_settings)
+            new_server = vpn_server_random()
+            record_chosen_server(servers_ranked, new_server)
+            with timed_phase("update_config"):
+                update_openvpn_config(ovpn_config_file, new_server, pinned_address(options, new_server),
+                                      ranked_uplink(new_server)[1], ranked_transport(new_server))
+            with timed_phase("start"):
+                debian_service_manager("openvpn", "start")
+                wait_for_tunnel(options.tun_interface or "tun0", ready_timeout, management)
+            with timed_phase("verify"):
+                check_internet()
+        elif server_os == "pfsense":
+            check_config_exists(PFSENSE_CONFIG_FILE)
+            with timed_phase("check_internet"):
+                check_internet()
+            with timed_phase("rank"):
+                servers_ranked = vpn_server_rank(server_count, server_filter, **rank_settings)
+            new_server = vpn_server_random()
+            record_chosen_server(servers_ranked, new_server)
+            with timed_phase("apply"):
+                apply_new_server(server_os, options, new_server)
+            with timed_phase("verify"):
+                check_internet()
+        RUN_RECORD["result"] = "ok"
+    finally:
+        write_run_record(options)
+
+
+def main():
+    """
+    Main function to run program.
+    """
+    global STATE_DIR
+    options = get_arguments()
+    STATE_DIR = getattr(options, "state_dir", STATE_DIR)
+    if options.command == "status":
+        # Read only and fast, no header, network or service access
+        show_status(options)
+        return
+    if options.command == "share":
+        serve_shared_results(options.listen)
+        return
+    show_header()
+    show_banner()
+    block_heading(f"IPVANISH OVPNMANGER STARTING {get_date()}")
+    check_arguments(options)
+    if options.command == "catalog":
+        show_catalog(options)
+    elif options.command == "probe":
+        show_probe(options)
+    elif options.command == "rank":
+        start_run_record("rank")
+        try:
+            with timed_phase("rank"):
+                vpn_server_rank(options.servers, options.filter, **get_rank_settings(options))
+            RUN_RECORD["result"] = "ok"
+        finally:
+            write_run_record(options)
+    else:
+        rotate(options)
 
     block_heading(f"OVPNMANGER HAS FINISHED {get_date()}")
 
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Self check of the ovpnmanager parts that talk to OpenVPN and VPN servers directly.
+Runs the management interface client against a mock management server and the finalist and
+transport stages against local TCP and UDP stand-in servers. Exits 1 if a check fails.
+No root, OpenVPN or IPVanish access required.
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+
+import ovpnmanager
+
+FAILURES = []
+
+
+def check(description, condition):
+    """
+    Show the result of one check and keep failed checks for the exit code
+    """
+    ovpnmanager.task_start(description)
+    if condition:
+        ovpnmanager.task_pass()
+    else:
+        ovpnmanager.task_fail()
+        FAILURES.append(description)
+
+
+def start_thread(target, *args):
+    threading.Thread(target=target, args=args, daemon=True).start()
+
+
+def serve_management(sock, commands):
+    """
+    Mock OpenVPN management interface. Replies with SUCCESS, ERROR or multi-line END framing and sends
+    the >STATE: and >REMOTE: real time notifications OpenVPN sends while reconnecting.
+    """
+    replies = {
+        "state on": "SUCCESS: real-time state notification set to ON",
+        "state": "1700000000,CONNECTED,SUCCESS,10.8.0.2,198.51.100.1\r\nEND",
+        "load-stats": "SUCCESS: nclients=0,bytesin=2048,bytesout=1024",
+        "signal SIGHUP": "SUCCESS: signal SIGHUP thrown\r\n>STATE:1700000001,RECONNECTING,SIGHUP,,\r\n"
+                         ">STATE:1700000002,CONNECTED,SUCCESS,10.8.0.2,198.51.100.2",
+        "signal SIGUSR1": "SUCCESS: signal SIGUSR1 thrown\r\n>STATE:1700000001,RECONNECTING,SIGUSR1,,\r\n"
+                          ">REMOTE:nyc-a01.ipvanish.com,1194,udp",
+    }
+    while True:
+        connection, _ = sock.accept()
+        with connection, connection.makefile("rw", newline="") as stream:
+            stream.write(">INFO:OpenVPN Management Interface Version 3 -- type 'help' for more info\r\n")
+            stream.flush()
+            for line in stream:
+                command = line.strip()
+                commands.append(command)
+                if command.startswith("remote MOD"):
+                    reply = "SUCCESS: remote command succeeded\r\n" \
+                            ">STATE:1700000003,CONNECTED,SUCCESS,10.8.0.2,198.51.100.3"
+                else:
+                    reply = replies.get(command, f"ERROR: unknown command [{command}]")
+                stream.write(reply + "\r\n")
+                stream.flush()
+
+
+def check_management():
+    """
+    Check the management client framing, notifications and both reconnect paths
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    commands = []
+    start_thread(serve_management, sock, commands)
+    address = f"127.0.0.1:{sock.getsockname()[1]}"
+    with ovpnmanager.OpenVPNManagement(address) as client:
+        check("Management state reply ends with END", client.state()["state"] == "CONNECTED")
+        check("Management load-stats byte counters", client.byte_count() == (2048, 1024))
+        try:
+            client.command("bogus")
+            error = False
+        except RuntimeError:
+            error = True
+        check("Management ERROR reply raises", error)
+    del commands[:]
+    connected = ovpnmanager.management_reconnect(address, "lax-a01.ipvanish.com", None, True, 5)
+    check("Reconnect answers >REMOTE: with the port of the query",
+          connected and "remote MOD lax-a01.ipvanish.com 1194" in commands)
+    del commands[:]
+    connected = ovpnmanager.management_reconnect(address, "lax-a01.ipvanish.com", 443, False, 5)
+    check("Reconnect with SIGHUP waits for >STATE: CONNECTED", connected and "signal SIGHUP" in commands)
+    sock.close()
+
+
+def serve_tcp(sock):
+    """
+    TCP stand-in server accepting connections without TLS
+    """
+    while True:
+        connection, _ = sock.accept()
+        connection.close()
+
+
+def serve_openvpn_udp(sock):
+    """
+    UDP stand-in server answering an OpenVPN client hard reset with a server hard reset
+    acknowledging the client session id
+    """
+    while True:
+        data, address = sock.recvfrom(2048)
+        if len(data) < 9 or data[0] >> 3 != ovpnmanager.OPENVPN_HARD_RESET_CLIENT_V2:
+            continue
+        reply = bytes([ovpnmanager.OPENVPN_HARD_RESET_SERVER_V2 << 3]) + os.urandom(8) + bytes([1]) + \
+            struct.pack("!I", 0) + data[1:9] + struct.pack("!I", 0)
+        sock.sendto(reply, address)
+
+
+def closed_port():
+    """
+    Return a local port nothing listens on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def check_finalists(tcp_port):
+    """
+    Check the finalist probe against the TCP stand-in and that failed finalists are dropped
+    """
+    result = ovpnmanager.bandwidth_probe("127.0.0.1", tcp_port, timeout=2, path=None)
+    check("Finalist probe measures connect time", result["connect"] is not None and result["handshake"] is None)
+    result = ovpnmanager.bandwidth_probe("127.0.0.1", closed_port(), timeout=2, path=None)
+    check("Finalist probe of a closed port has no connect time", result["connect"] is None)
+    passed = {"nyc-a01.ipvanish.com", "lax-a01.ipvanish.com"}
+    bandwidth_probe = ovpnmanager.bandwidth_probe
+    ovpnmanager.bandwidth_probe = lambda host, **options: {
+        "connect": 20.0 if host in passed else None, "handshake": 40.0 if host in passed else None,
+        "throughput": None}
+    try:
+        servers = [(city, f"{city}-a01", 10, "", {"rounds": 1, "score": score, "samples": 0})
+                   for city, score in (("chi", 10), ("nyc", 20), ("dal", 30), ("lax", 40), ("sea", 50))]
+        ranked = ovpnmanager.measure_finalists(servers, 4, finalist_time=2)
+    finally:
+        ovpnmanager.bandwidth_probe = bandwidth_probe
+    check("Failed finalists are dropped", [server[1] for server in ranked] == ["nyc-a01", "lax-a01", "sea-a01"])
+
+
+def check_transports(tcp_port, udp_port):
+    """
+    Check the transport probes against the stand-in servers and the transport ranking
+    """
+    check("UDP hard reset round trip", ovpnmanager.openvpn_udp_ping("127.0.0.1", udp_port, timeout=2) is not None)
+    check("UDP without a server has no round trip",
+          ovpnmanager.openvpn_udp_ping("127.0.0.1", closed_port(), timeout=0.5) is None)
+    check("TCP connect time", ovpnmanager.openvpn_tcp_ping("127.0.0.1", tcp_port, timeout=2) is not None)
+    check("TCP refused has no connect time", ovpnmanager.openvpn_tcp_ping("127.0.0.1", closed_port()) is None)
+    # Servers starting with chi have no stand-in server
+    resolve_host = ovpnmanager.resolve_host
+    ovpnmanager.resolve_host = lambda host: ["127.0.0.2" if host.startswith("chi") else "127.0.0.1"]
+    try:
+        servers = [(city, f"{city}-a01", 10, "", {"rounds": 1, "score": score, "samples": 0})
+                   for city, score in (("chi", 10), ("nyc", 20), ("lax", 30))]
+        ranked = ovpnmanager.measure_transports(servers, [("udp", udp_port), ("tcp", tcp_port)], 2, samples=1)
+    finally:
+        ovpnmanager.resolve_host = resolve_host
+    check("Servers without an answering transport rank behind",
+          [server[1] for server in ranked] == ["nyc-a01", "chi-a01", "lax-a01"])
+    check("Fastest transport is kept", ranked[0][4].get("proto") in ("udp", "tcp") and "proto" not in ranked[1][4])
+    config = "client\nproto udp\nremote nyc-a01.ipvanish.com 443\nverify-x509-name nyc-a01.ipvanish.com name\n"
+    config = ovpnmanager.update_openvpn_directives(config, "lax-a01.ipvanish.com", transport=("tcp", 1194))
+    check("Transport written to proto and remote",
+          "proto tcp\n" in config and "remote lax-a01.ipvanish.com 1194\n" in config)
+
+
+def main():
+    """
+    Run the checks and exit 1 if any failed
+    """
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.bind(("127.0.0.1", 0))
+    tcp_sock.listen()
+    start_thread(serve_tcp, tcp_sock)
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.bind(("127.0.0.1", 0))
+    start_thread(serve_openvpn_udp, udp_sock)
+    ovpnmanager.task_info("Checking the OpenVPN management client against a mock management server")
+    check_management()
+    ovpnmanager.task_info("Checking the finalist stage against a local TCP stand-in server")
+    check_finalists(tcp_sock.getsockname()[1])
+    ovpnmanager.task_info("Checking the transport stage against local TCP and UDP stand-in servers")
+    check_transports(tcp_sock.getsockname()[1], udp_sock.getsockname()[1])
+    if FAILURES:
+        ovpnmanager.task_error(f"{len(FAILURES)} checks failed")
+        sys.exit(1)
+    ovpnmanager.task_info("All checks passed")
+
+
+if __name__ == "__main__":
+    main()